@@ -1,14 +1,79 @@
+import argparse
+import contextlib
+import gzip
+import io
+import json
+import multiprocessing
 import sys
+import time
 import numpy as np
 
 # error rate for the emission probabilities
 ERROR_RATE = 1 / 1000
+# genotype codes; any other field (e.g. missing './.' or a non-genotype column) is coded as MISSING and skipped
+HOMOZYGOUS, HETEROZYGOUS, MISSING = 0, 1, 2
+GENOTYPE_CODES = {'0/0': HOMOZYGOUS, '1/1': HOMOZYGOUS, '0/1': HETEROZYGOUS, '1/0': HETEROZYGOUS}
+# emission probabilities for inbred and outbred states indexed by genotype code, as emission_probabilities gives
+# them with p = q = 0.5 (the MISSING entry is unused)
+E_INBRED = np.array([1 - ERROR_RATE, ERROR_RATE, 1.0])
+E_OUTBRED = np.array([1 - 2 * 0.5 * 0.5, 2 * 0.5 * 0.5, 1.0])
+# largest initial rate of the multi-start grid, keeping every start (and its perturbed simplex) a probability
+MAX_START_RATE = 0.4
+# records processed at a time by baum_welch, bounding the memory of the stored forward variables
+BLOCK_RECORDS = 65536
+# read buffer of vcf files; compressed files are decompressed this many bytes at a time
+READ_BUFFER_BYTES = 1 << 24
+
+def open_vcf(vcf_file):
+    """open a plain or gzip/bgzip compressed vcf file for reading text with a READ_BUFFER_BYTES buffer."""
+    with open(vcf_file, 'rb') as f:
+        compressed = f.read(2) == b'\x1f\x8b'  # gzip magic number, also used by bgzip
+    raw = gzip.open(vcf_file, 'rb') if compressed else open(vcf_file, 'rb', buffering=0)
+    return io.TextIOWrapper(io.BufferedReader(raw, READ_BUFFER_BYTES))
+
+def iter_vcf_chromosomes(vcf_file):
+    """stream a plain or gzip/bgzip compressed vcf file in blocks of about READ_BUFFER_BYTES and yield
+    (chrom, records) for each run of consecutive records on the same chromosome, so only one chromosome of records is
+    held at a time."""
+    chrom, records = None, []
+    with open_vcf(vcf_file) as f:
+        while True:
+            lines = f.readlines(READ_BUFFER_BYTES)
+            if not lines:
+                break
+            for line in lines:
+                if line.startswith('#'):
+                    continue  # skip header lines
+                record = line.strip().split('\t')
+                if record[0] != chrom:
+                    if records:
+                        yield chrom, records
+                    chrom, records = record[0], []
+                records.append(record)
+    if records:
+        yield chrom, records
 
 def parse_vcf(vcf_file):
     """parse the vcf file and return records as a list of lists."""
-    with open(vcf_file, 'r') as f:
-        # read each line, skipping header lines, and split by tab to get genotype information
-        return [line.strip().split('\t') for line in f if not line.startswith('#')]
+    # read each line, skipping header lines, and split by tab to get genotype information
+    return [record for _, records in iter_vcf_chromosomes(vcf_file) for record in records]
+
+def encode_genotypes(vcf_data):
+    """encode the genotype fields (everything after the first four columns) of parsed vcf records as an int8 matrix
+    with one row per record; shorter records are padded with MISSING."""
+    width = max((len(record) - 4 for record in vcf_data), default=0)
+    codes = np.full((len(vcf_data), width), MISSING, dtype=np.int8)
+    for row, record in enumerate(vcf_data):
+        codes[row, :len(record) - 4] = [GENOTYPE_CODES.get(genotype, MISSING) for genotype in record[4:]]
+    return codes
+
+def read_genotype_matrix(vcf_file):
+    """stream the vcf file one chromosome at a time and encode it, so only the int8 genotype matrix of the whole
+    file is kept. returns the matrix with one row per record."""
+    matrices = [encode_genotypes(records) for _, records in iter_vcf_chromosomes(vcf_file)]
+    width = max((matrix.shape[1] for matrix in matrices), default=0)
+    return np.concatenate([np.pad(matrix, ((0, 0), (0, width - matrix.shape[1])), constant_values=MISSING)
+                           for matrix in matrices] or [np.zeros((0, 0), dtype=np.int8)])
 
 def emission_probabilities(genotype, p, q):
     """calculate emission probabilities for inbred and outbred states based on the genotype."""
@@ -23,61 +88,227 @@ def emission_probabilities(genotype, p, q):
     return None, None  # return None if genotype is not recognized
 
 def forward_algorithm(vcf_data, trans_inbred_outbred, trans_outbred_inbred):
-    """compute total likelihood using the forward algorithm for hidden markov models."""
-    total_likelihood = 0  # initialize the total likelihood
-    # loop through each record (row) in the vcf data
-    for record in vcf_data:
-        _, _, _, _, *genotypes = record  # extract the genotype information
-        p = 0.5  # initial probability for inbred state
-        q = 1 - p  # probability for outbred state
-
-        # initialize forward variables for inbred and outbred states
-        f_inbred, f_outbred = 1.0, 1.0
-
-        # process each genotype in the record
-        for genotype in genotypes:
-            # calculate emission probabilities for inbred and outbred states
-            e_inbred, e_outbred = emission_probabilities(genotype, p, q)
-            if e_inbred is None:  # skip if the genotype is not valid
-                continue
-
-            # calculate the next state probabilities for inbred and outbred
-            next_inbred = f_inbred * (1 - trans_inbred_outbred) * e_inbred + \
-                          f_outbred * trans_outbred_inbred * e_inbred
-            next_outbred = f_outbred * (1 - trans_outbred_inbred) * e_outbred + \
-                           f_inbred * trans_inbred_outbred * e_outbred
-
-            # update the forward variables
-            f_inbred, f_outbred = next_inbred, next_outbred
-
-        # add the log likelihood of the final states to the total likelihood
-        total_likelihood += np.log(f_inbred + f_outbred)
-
-    return total_likelihood
-
-def amoeba_optimization(vcf_data, initial_params, tolerance=1e-6, max_iterations=100):
-    """optimize transition rates using the amoeba (nelder-mead) algorithm."""
-    
-    def evaluate(params):
-        """evaluate the likelihood of the current parameters."""
-        # negate the result of the forward algorithm to minimize the negative log-likelihood
-        return -forward_algorithm(vcf_data, params[1], params[0])
+    """compute total likelihood using the forward algorithm for hidden markov models.
+
+    vcf_data is a genotype matrix from encode_genotypes (or parsed records, which are encoded first). the forward
+    variables of all records advance together, one genotype column at a time, and are rescaled to sum to one after
+    every step with the log of the scale factors accumulated, so long records cannot underflow.
+    """
+    codes = vcf_data if isinstance(vcf_data, np.ndarray) else encode_genotypes(vcf_data)
+    # initialize forward variables for inbred and outbred states of every record
+    f_inbred, f_outbred = np.ones(len(codes)), np.ones(len(codes))
+    log_scale = 0.0  # sum of the logs of all scale factors
+
+    # process each genotype column for all records at once
+    for column in codes.T:
+        valid = column != MISSING  # genotypes that are not valid are skipped
+        if not valid.any():
+            continue
+        next_inbred = (f_inbred * (1 - trans_inbred_outbred) + f_outbred * trans_outbred_inbred) * E_INBRED[column]
+        next_outbred = (f_outbred * (1 - trans_outbred_inbred) + f_inbred * trans_inbred_outbred) * E_OUTBRED[column]
+        scale = np.where(valid, next_inbred + next_outbred, 1.0)
+        log_scale += np.log(scale).sum()
+        f_inbred = np.where(valid, next_inbred, f_inbred) / scale
+        f_outbred = np.where(valid, next_outbred, f_outbred) / scale
+
+    # add the log likelihood of the final states to the total likelihood
+    return log_scale + np.log(f_inbred + f_outbred).sum()
+
+def expected_transitions(codes, trans_inbred_outbred, trans_outbred_inbred):
+    """run the scaled forward and backward passes over a block of encoded records, with the same model as
+    forward_algorithm. returns the log likelihood and the expected numbers of inbred>inbred, inbred>outbred,
+    outbred>inbred and outbred>outbred transitions."""
+    transitions = np.array([[1 - trans_inbred_outbred, trans_inbred_outbred],
+                            [trans_outbred_inbred, 1 - trans_outbred_inbred]])
+    num_records, num_columns = codes.shape
+    # forward pass: inbred share of the scaled forward variables after every column (column 0 is the start)
+    forward = np.empty((num_columns + 1, num_records))
+    forward[0] = 0.5
+    log_likelihood = num_records * np.log(2.0)  # both forward variables start at 1
+    for j, column in enumerate(codes.T, start=1):
+        valid = column != MISSING
+        next_inbred = (forward[j - 1] * transitions[0, 0] + (1 - forward[j - 1]) * transitions[1, 0]) * E_INBRED[column]
+        next_outbred = (forward[j - 1] * transitions[0, 1] + (1 - forward[j - 1]) * transitions[1, 1]) * E_OUTBRED[column]
+        scale = next_inbred + next_outbred
+        log_likelihood += np.log(scale[valid]).sum()
+        forward[j] = np.where(valid, next_inbred / scale, forward[j - 1])
+
+    # backward pass: posterior of the transition taken at every valid column
+    counts = np.zeros((2, 2))
+    beta = np.full((num_records, 2), 0.5)  # scaled backward variables
+    for j in range(num_columns, 0, -1):
+        column = codes[:, j - 1]
+        valid = column != MISSING
+        emitted = beta * np.column_stack((E_INBRED[column], E_OUTBRED[column]))  # e(k) * beta(k) at column j
+        previous = np.column_stack((forward[j - 1], 1 - forward[j - 1]))
+        joint = previous[:, :, None] * transitions[None, :, :] * emitted[:, None, :]  # (records, from, to)
+        joint /= joint.sum(axis=(1, 2), keepdims=True)
+        counts += joint[valid].sum(axis=0)
+        next_beta = emitted @ transitions.T
+        beta = np.where(valid[:, None], next_beta / next_beta.sum(axis=1, keepdims=True), beta)
+    return log_likelihood, counts.ravel()
+
+def baum_welch(vcf_data, initial_params, tolerance=1e-6, max_iterations=1000):
+    """estimate transition rates with the baum-welch (expectation-maximization) algorithm.
+
+    every iteration runs one forward and one backward pass over the records, BLOCK_RECORDS at a time, and sets each
+    rate to its expected number of transitions divided by the expected number of steps leaving the state (or keeps it
+    when the state is never left). stops once the log likelihood changes by less than tolerance, the same absolute
+    threshold nelder_mead applies to the spread of its values; non-finite likelihoods or rates count as not converged. params are ordered as in
+    amoeba_optimization: [p(outbred>inbred), p(inbred>outbred)]. returns the rates, the convergence trace (one
+    dictionary per iteration with the rates used and their log likelihood) and whether it converged.
+    """
+    codes = vcf_data if isinstance(vcf_data, np.ndarray) else encode_genotypes(vcf_data)
+    params = np.array(initial_params, dtype=np.float64)
+    trace = []
+    previous_likelihood = -np.inf
+    for iteration in range(max_iterations):
+        log_likelihood, counts = 0.0, np.zeros(4)
+        for block in range(0, len(codes), BLOCK_RECORDS):
+            block_likelihood, block_counts = expected_transitions(codes[block:block + BLOCK_RECORDS], params[1], params[0])
+            log_likelihood += block_likelihood
+            counts += block_counts
+        trace.append({"iteration": iteration, "trans_outbred_inbred": float(params[0]),
+                      "trans_inbred_outbred": float(params[1]), "log_likelihood": float(log_likelihood)})
+        if not np.isfinite(log_likelihood):
+            return params, trace, False
+        if abs(log_likelihood - previous_likelihood) < tolerance:
+            return params, trace, True
+        previous_likelihood = log_likelihood
+        inbred_to_inbred, inbred_to_outbred, outbred_to_inbred, outbred_to_outbred = counts
+        moved = np.array([outbred_to_inbred, inbred_to_outbred])
+        leaving = np.array([outbred_to_inbred + outbred_to_outbred, inbred_to_inbred + inbred_to_outbred])
+        # a state never left (e.g. no valid genotypes at all) gives no information, so its rate is kept
+        params = np.where(leaving > 0, moved / np.where(leaving > 0, leaving, 1.0), params)
+        if not np.isfinite(params).all():
+            return params, trace, False
+    return params, trace, False
+
+_worker_state = {}  # genotype matrix of the current process, filled once by init_likelihood_worker
+
+def init_likelihood_worker(codes):
+    """store the genotype matrix once per worker process so tasks only carry parameter vectors. no return value."""
+    _worker_state.clear()
+    _worker_state["codes"] = codes
+
+def timed_negative_log_likelihood(codes, params):
+    """evaluate the negative log likelihood of params = [p(outbred>inbred), p(inbred>outbred)]. returns the value and
+    the seconds taken."""
+    start_time = time.perf_counter()
+    value = -forward_algorithm(codes, params[1], params[0])
+    return value, time.perf_counter() - start_time
+
+def negative_log_likelihood(params):
+    """evaluate params on the genotype matrix of the current process, possibly in a worker process. returns the value
+    and the seconds taken."""
+    return timed_negative_log_likelihood(_worker_state["codes"], params)
+
+class MemoizedObjective:
+    """negative log likelihood of the transition rates, cached by parameter vector. evaluate_many computes the
+    uncached points of a batch (e.g. the vertices of a new or shrunk simplex) concurrently when a pool is given."""
+
+    def __init__(self, codes, pool=None):
+        self.codes = codes
+        self.pool = pool  # process pool initialized with init_likelihood_worker(codes), or None
+        self.cache = {}
+        self.evaluation_seconds = []  # time taken by every likelihood actually computed
+        self.cache_hits = 0
+
+    def __call__(self, params):
+        return self.evaluate_many([params])[0]
+
+    def evaluate_many(self, points):
+        """evaluate a list of parameter vectors. returns their values in order."""
+        keys = [tuple(np.asarray(point, dtype=np.float64).tolist()) for point in points]
+        missing = list(dict.fromkeys(key for key in keys if key not in self.cache))
+        self.cache_hits += len(keys) - len(missing)
+        if self.pool is not None and len(missing) > 1:
+            results = self.pool.map(negative_log_likelihood, missing)
+        else:
+            results = [timed_negative_log_likelihood(self.codes, key) for key in missing]
+        for key, (value, seconds) in zip(missing, results):
+            self.cache[key] = value
+            self.evaluation_seconds.append(seconds)
+        return [self.cache[key] for key in keys]
+
+    def summary(self):
+        """summarize the evaluations so far for an optimizer trace. returns a dictionary."""
+        return {"evaluations": len(self.evaluation_seconds), "cache_hits": self.cache_hits,
+                "total_evaluation_seconds": sum(self.evaluation_seconds), "evaluation_seconds": self.evaluation_seconds}
+
+def amoeba_optimization(vcf_data, initial_params, tolerance=1e-6, max_iterations=100, workers=1, trace=None):
+    """optimize transition rates using the amoeba (nelder-mead) algorithm. likelihoods are memoized, and with
+    workers > 1 the vertices of the initial and shrunk simplices are evaluated in a process pool. if trace is a
+    dictionary, it is filled with the instrumentation of the run (see nelder_mead and MemoizedObjective.summary)."""
+    start_time = time.perf_counter()
+    # encode the genotypes once for all evaluations
+    codes = vcf_data if isinstance(vcf_data, np.ndarray) else encode_genotypes(vcf_data)
+    pool = multiprocessing.Pool(workers, initializer=init_likelihood_worker, initargs=(codes,)) if workers > 1 else None
+    with pool or contextlib.nullcontext():
+        evaluate = MemoizedObjective(codes, pool)
+        best = nelder_mead(evaluate, initial_params, tolerance, max_iterations, trace)
+    if trace is not None:
+        trace.update(evaluate.summary(), wall_seconds=time.perf_counter() - start_time, result=best.tolist())
+    return best
+
+def run_amoeba_start(task):
+    """run one amoeba optimization on the genotype matrix of the current process, possibly in a worker process.
+    returns the best value, the best parameters and the trace of the run (None unless traced)."""
+    initial_params, tolerance, max_iterations, traced = task
+    start_time = time.perf_counter()
+    trace = {} if traced else None
+    evaluate = MemoizedObjective(_worker_state["codes"])
+    best = nelder_mead(evaluate, initial_params, tolerance, max_iterations, trace)
+    if traced:
+        trace.update(evaluate.summary(), wall_seconds=time.perf_counter() - start_time, initial_params=list(initial_params),
+                     result=best.tolist())
+    return evaluate(best), best, trace
+
+def starting_grid(initial_params, num_starts):
+    """scale initial_params by num_starts factors spaced geometrically from 1 up to the one that brings the largest rate
+    to MAX_START_RATE, so every start stays inside (0, 1). returns a list of parameter lists."""
+    scales = np.geomspace(1, MAX_START_RATE / max(initial_params), num_starts)
+    return [[rate * scale for rate in initial_params] for scale in scales.tolist()]
+
+def multi_start_optimization(vcf_data, starts, tolerance=1e-6, max_iterations=100, workers=1, trace=None):
+    """run the amoeba optimization from every initial parameter vector in starts, concurrently when workers > 1, and
+    keep the result with the best finite likelihood. if trace is a dictionary, it gets the trace of every start and the
+    index of the best one. returns the optimized rates."""
+    codes = vcf_data if isinstance(vcf_data, np.ndarray) else encode_genotypes(vcf_data)
+    tasks = [(list(start), tolerance, max_iterations, trace is not None) for start in starts]
+    if workers > 1:
+        with multiprocessing.Pool(workers, initializer=init_likelihood_worker, initargs=(codes,)) as pool:
+            results = pool.map(run_amoeba_start, tasks)
+    else:
+        init_likelihood_worker(codes)
+        results = [run_amoeba_start(task) for task in tasks]
+    values = np.array([result[0] for result in results])
+    best_start = int(np.argmin(np.where(np.isfinite(values), values, np.inf)))  # a nan likelihood never wins
+    if trace is not None:
+        trace.update(starts=[result[2] for result in results], best_start=best_start)
+    return results[best_start][1]
 
+def nelder_mead(evaluate, initial_params, tolerance=1e-6, max_iterations=100, trace=None):
+    """minimize evaluate, a MemoizedObjective, with the amoeba (nelder-mead) algorithm. if trace is a dictionary, it
+    gets one entry per iteration (step taken: reflect, expand, contract or shrink; best value; evaluations so far) and
+    whether the tolerance was reached. returns the best point."""
+    iterations = []
+    converged = False
     # initialize the simplex (starting points for the optimization)
     simplex = [np.array(initial_params)]
     
     # generate the perturbed points for the simplex
     for i in range(len(initial_params)):
-        perturbed = initial_params[:]
+        perturbed = list(initial_params)
         perturbed[i] *= 1.1  # increase the i-th parameter by 10%
         simplex.append(np.array(perturbed))
 
     # convert the simplex to a numpy array and evaluate the initial values
     simplex = np.array(simplex)
-    values = [evaluate(point) for point in simplex]
+    values = evaluate.evaluate_many(simplex)
 
     # perform the optimization using the amoeba algorithm (nelder-mead)
-    for _ in range(max_iterations):
+    for iteration in range(max_iterations):
         # sort the simplex by function values
         order = np.argsort(values)
         simplex = simplex[order]
@@ -99,13 +330,16 @@ def amoeba_optimization(vcf_data, initial_params, tolerance=1e-6, max_iterations
             if expansion_value < reflection_value:
                 simplex[-1] = expansion
                 values[-1] = expansion_value
+                step = "expand"
             else:
                 simplex[-1] = reflection
                 values[-1] = reflection_value
+                step = "reflect"
         elif reflection_value < values[-2]:
             # accept reflection if it is not worse than the second-to-worst point
             simplex[-1] = reflection
             values[-1] = reflection_value
+            step = "reflect"
         else:
             # contraction step
             contraction = centroid + 0.5 * (worst - centroid)
@@ -113,34 +347,69 @@ def amoeba_optimization(vcf_data, initial_params, tolerance=1e-6, max_iterations
             if contraction_value < values[-1]:
                 simplex[-1] = contraction
                 values[-1] = contraction_value
+                step = "contract"
             else:
                 # shrink the simplex towards the best point
                 best = simplex[0]
-                simplex = [best + 0.5 * (point - best) for point in simplex]
-                values = [evaluate(point) for point in simplex]
+                simplex = np.array([best + 0.5 * (point - best) for point in simplex])
+                values = evaluate.evaluate_many(simplex)
+                step = "shrink"
+        iterations.append({"iteration": iteration, "step": step, "best_value": float(np.min(values)),
+                           "evaluations": len(evaluate.evaluation_seconds)})
 
         # check if the optimization has converged (tolerance condition)
         if np.max(np.abs(np.array(values) - values[0])) < tolerance:
+            converged = True
             break
 
+    if trace is not None:
+        trace.update(iterations=iterations, converged=converged)
     return simplex[0]
 
 if __name__ == "__main__":
-    # check if the user provided the correct number of arguments (vcf file)
-    if len(sys.argv) != 2:
-        print("usage: python amoebaoptimization.py <input>.vcf")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="estimate inbred/outbred transition rates from a vcf file.")
+    parser.add_argument("vcf_file", help="input vcf file, plain or gzip/bgzip compressed.")
+    parser.add_argument("--method", choices=["em", "amoeba"], default="em",
+                        help="baum-welch (em, falls back to amoeba if it does not converge) or amoeba (nelder-mead) (default em).")
+    parser.add_argument("--workers", type=int, default=1, help="worker processes for the amoeba optimization (default 1).")
+    parser.add_argument("--starts", type=int, default=1,
+                        help="amoeba runs from the initial rates scaled up geometrically to at most %g; the best result is kept (default 1)." % MAX_START_RATE)
+    parser.add_argument("--trace", default=None,
+                        help="write a json trace of the optimization (evaluations, timings, steps, best value per iteration) to this file.")
+    args = parser.parse_args()
 
-    # get the input vcf file from command-line arguments
-    vcf_file = sys.argv[1]
-    # parse the vcf file to get the data
-    vcf_data = parse_vcf(vcf_file)
+    # parse the vcf file to get the genotype matrix
+    vcf_data = read_genotype_matrix(args.vcf_file)
 
     # define initial parameters for the transition rates
     initial_params = [1 / (4 * 10**6), 1 / (1.5 * 10**6)]
 
-    # perform optimization of the transition rates using the amoeba algorithm
-    optimized_rates = amoeba_optimization(vcf_data, initial_params)
+    converged = False
+    optimizer_trace = {"method": args.method} if args.trace else None
+    if args.method == "em":
+        # estimate the transition rates with baum-welch and report the convergence trace
+        optimized_rates, trace, converged = baum_welch(vcf_data, initial_params)
+        if optimizer_trace is not None:
+            optimizer_trace["em"] = {"iterations": trace, "converged": converged}
+        for step in trace:
+            print(f"em iteration {step['iteration']}: log likelihood {step['log_likelihood']:.6f}, "
+                  f"p(outbred>inbred) {step['trans_outbred_inbred']:.10f}, "
+                  f"p(inbred>outbred) {step['trans_inbred_outbred']:.10f}", file=sys.stderr)
+        if not converged:
+            print("em did not converge, falling back to amoeba optimization", file=sys.stderr)
+    amoeba_trace = {} if optimizer_trace is not None and not converged else None
+    if not converged and args.starts > 1:
+        # perform optimization of the transition rates from several starting points using the amoeba algorithm
+        starts = starting_grid(initial_params, args.starts)
+        optimized_rates = multi_start_optimization(vcf_data, starts, workers=args.workers, trace=amoeba_trace)
+    elif not converged:
+        # perform optimization of the transition rates using the amoeba algorithm
+        optimized_rates = amoeba_optimization(vcf_data, initial_params, workers=args.workers, trace=amoeba_trace)
+    if optimizer_trace is not None:
+        if amoeba_trace is not None:
+            optimizer_trace["amoeba"] = amoeba_trace
+        with open(args.trace, "w") as f:
+            json.dump(optimizer_trace, f, indent=2)
 
     # print the optimized transition rates
     print(f"p(transition outbred>inbred): {optimized_rates[0]:.10f}")
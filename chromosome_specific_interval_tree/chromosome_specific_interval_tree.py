@@ -1,194 +1,765 @@
-import random
-import sys
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+import numpy as np
 
-# Interval Node
-class IntervalNode:
-    def __init__(self, interval):
-        self.interval = interval  # (chromosome, start, end)
-        self.max = interval[2]  # max is the end of the interval
-        self.left = None  # left child
-        self.right = None  # right child
+# z-score of the confidence interval checked after every batch when stopping early; wide because it is checked repeatedly
+EARLY_STOP_Z = 3.0
+# suffix of the sidecar files that cache parsed BED and FAI inputs
+CACHE_SUFFIX = '.cache'
+# suffix of the sidecar files that hold a saved reference index
+INDEX_SUFFIX = '.index'
+# shuffled interval placements scored per batch when permutation_test is not given a batch_size
+BATCH_ELEMENTS = 1000000
+# name of the single chromosome that holds the whole genome in flattened coordinates
+GENOME_CHROM = 'genome'
+
+# Interval Set
+class IntervalSet:
+    '''
+    Columnar set of intervals sorted by chromosome, then start: an integer chromosome code per interval, int64 start
+    and end arrays, and the chromosome names the codes index into. The arrays may be memory-mapped from a cache file.
+    '''
+    def __init__(self, chrom_names, chrom_codes, starts, ends):
+        self.chrom_names = list(chrom_names)  # chromosome code -> chromosome name
+        self.chrom_index = {chrom: code for code, chrom in enumerate(self.chrom_names)}  # chromosome name -> code
+        self.chrom_codes = chrom_codes
+        self.starts = starts
+        self.ends = ends
+
+    def chromosome(self, chrom):
+        '''
+        Get the intervals on one chromosome. Returns start-sorted (starts, ends) views, empty if chrom is absent.
+        '''
+        code = self.chrom_index.get(chrom)
+        if code is None:
+            return self.starts[:0], self.ends[:0]
+        first, last = np.searchsorted(self.chrom_codes, [code, code + 1])  # codes are sorted, so chrom is one block
+        return self.starts[first:last], self.ends[first:last]
+
+    def chromosomes(self):
+        '''
+        Iterate over the chromosomes that have intervals, in code order, walking the block boundaries of the sorted
+        codes once. Yields (chromosome, starts, ends).
+        '''
+        bounds = np.concatenate(([0], np.flatnonzero(np.diff(self.chrom_codes)) + 1, [len(self.chrom_codes)]))
+        for first, last in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+            if last > first:
+                yield self.chrom_names[self.chrom_codes[first]], self.starts[first:last], self.ends[first:last]
 
 # Interval Tree
 class IntervalTree:
+    '''
+    Array-backed interval index. Merged intervals are stored per chromosome as sorted int64 start and end arrays.
+    Merged intervals never overlap, so the end array is sorted too and acts as the running max of ends:
+    a query is two binary searches (searchsorted) instead of a walk over node objects.
+    '''
     def __init__(self):
-        self.root = None  # root node
+        self.path = None  # reference file of an index opened by load_index
+        self.columns_path = None  # to_columns file of an index opened by load_columns
+        self.starts = {}  # chromosome -> sorted start positions
+        self.ends = {}  # chromosome -> sorted end positions (running max of ends)
+        self.cumulative = {}  # chromosome -> indexed bases up to and including each interval (read by sweep_overlap)
 
-    def build_balanced_tree(self, intervals):
+    def insert_intervals(self, intervals):
         '''
-        Build a balanced interval tree from a list of intervals. 
+        Insert intervals into the interval tree. Called by permutation_test. No return value.
         '''
-        if not intervals:  # base case for empty list
-            return None
-        median = len(intervals) // 2  # find median
-        root = IntervalNode(intervals[median])  # create root node
-        root.left = self.build_balanced_tree(intervals[:median])  # left subtree
-        root.right = self.build_balanced_tree(intervals[median + 1:])  # right subtree
-        root.max = max(root.interval[2],
-                       root.left.max if root.left else float('-inf'),
-                       root.right.max if root.right else float('-inf'))
-        return root
+        for chrom, starts, ends in to_interval_set(intervals).chromosomes():
+            starts, ends = merge_intervals(starts, ends) # make sure set is merged before building
+            self.starts[chrom] = starts
+            self.ends[chrom] = ends
+            self.cumulative[chrom] = np.cumsum(ends - starts)
 
-    def insert_intervals(self, intervals):
+    def find_overlaps(self, query_interval):
+        '''
+        Find overlapping intervals in the interval tree. Returns a list of overlapping intervals.
         '''
-        Insert intervals into the interval tree. Called by __init__. No return value.
+        chrom, query_start, query_end = query_interval
+        if chrom not in self.starts:
+            return []
+        starts = self.starts[chrom]
+        ends = self.ends[chrom]
+        first = np.searchsorted(ends, query_start, side='right')  # first interval ending after the query start
+        last = np.searchsorted(starts, query_end, side='left')  # first interval starting at or after the query end
+        return [(chrom, start, end) for start, end in zip(starts[first:last].tolist(), ends[first:last].tolist())]
+
+    def find_overlaps_many(self, chrom, query_starts, query_ends):
+        '''
+        Find the overlapping intervals of many queries on one chromosome at once, in CSR form: the hits of query i are
+        hit_indices[offsets[i]:offsets[i + 1]], indices into self.starts[chrom] and self.ends[chrom], so overlap lengths
+        can be computed with array operations instead of per-hit tuples. Returns (offsets, hit_indices).
         '''
-        merged_intervals = merge_intervals(intervals) # make sure set is merged before building
-        self.root = self.build_balanced_tree(merged_intervals)
+        query_starts = np.asarray(query_starts, dtype=np.int64)
+        query_ends = np.asarray(query_ends, dtype=np.int64)
+        if chrom not in self.starts:
+            return np.zeros(len(query_starts) + 1, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        first = np.searchsorted(self.ends[chrom], query_starts, side='right')  # first interval ending after each query start
+        last = np.searchsorted(self.starts[chrom], query_ends, side='left')  # first interval starting at or after each query end
+        counts = np.maximum(last - first, 0)
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        # hits of each query are the consecutive indices first, first + 1, ..., last - 1
+        hit_indices = np.arange(offsets[-1], dtype=np.int64) + np.repeat(first - offsets[:-1], counts)
+        return offsets, hit_indices
 
-    def do_overlap(self, interval1, interval2):
+    def to_columns(self):
         '''
-        Check if two intervals overlap. Called by search_overlapping. Returns True if they overlap, False otherwise.
+        Flatten the index into one int64 array with rows chromosome code, start, end and cumulative bases, in the order
+        of self.starts. Called by load_index. Returns the column array.
         '''
-        return (interval1[0] == interval2[0] and
-        interval1[1] < interval2[2] and
-        interval2[1] < interval1[2])
+        chroms = list(self.starts.keys())
+        codes = [np.full(len(self.starts[chrom]), code, dtype=np.int64) for code, chrom in enumerate(chroms)]
+        return np.stack([np.concatenate(column) if column else np.zeros(0, dtype=np.int64) for column in
+                         (codes, [self.starts[c] for c in chroms], [self.ends[c] for c in chroms], [self.cumulative[c] for c in chroms])])
 
-    def search_overlapping(self, root, query_interval, result):
-        ''' 
-        Search for overlapping intervals in the interval tree recursively. Called by find_overlaps.
+    @classmethod
+    def from_columns(cls, chrom_names, columns, path=None):
         '''
-        if root is None: 
-            return
-        if self.do_overlap(root.interval, query_interval):
-            result.append(root.interval)
-        # only search left subtree if there's a chance of overlap
-        if root.left is not None and root.left.max > query_interval[1]: # 
-            self.search_overlapping(root.left, query_interval, result)
-        # Search right subtree if the current interval's max is greater than the query start
-        # ensures that we only search the right subtree if the starting position of the current interval 
-        # is less than the end position of the query interval
-        if root.right is not None and root.interval[1] < query_interval[2]: 
-            self.search_overlapping(root.right, query_interval, result)
+        Rebuild an index from a to_columns array; every per-chromosome array is a view into columns, so a
+        memory-mapped array is never copied. path records the reference file for pickling. Returns an IntervalTree.
+        '''
+        interval_tree = cls()
+        for code, chrom in enumerate(chrom_names):
+            first, last = np.searchsorted(columns[0], [code, code + 1])
+            interval_tree.starts[chrom] = columns[1, first:last]
+            interval_tree.ends[chrom] = columns[2, first:last]
+            interval_tree.cumulative[chrom] = columns[3, first:last]
+        interval_tree.path = path
+        return interval_tree
 
-    def find_overlaps(self, query_interval):
-        ''' 
-        Find overlapping intervals in the interval tree.
+    def share(self, columns_path):
+        '''
+        Save the index to columns_path (a .npy file) and reopen it memory-mapped read-only, for indexes that have no
+        reference file such as a flattened tree. Returns the memory-mapped IntervalTree, which pickles as the file.
+        '''
+        np.save(columns_path, self.to_columns())
+        return load_columns(columns_path, list(self.starts.keys()))
+
+    def __reduce__(self):
+        '''
+        Pickle an index opened by load_index as its reference path, or one opened by load_columns as its column file,
+        so worker processes memory-map the same index file (and share its pages) instead of receiving a copy of the
+        arrays.
         '''
-        result = []  # automatically remove duplicate overlaps for efficiency
-        self.search_overlapping(self.root, query_interval, result)
-        return result
+        if self.path is not None:
+            return load_index, (self.path,)
+        if self.columns_path is not None:
+            return load_columns, (self.columns_path, list(self.starts.keys()))
+        return object.__reduce__(self)
+
+# Genome Space
+class GenomeSpace:
+    '''
+    Flattened coordinate space for shuffling. Chromosomes are laid end to end at cumulative offsets and excluded
+    regions are cut out, leaving allowed segments in flattened coordinates. A uniform draw over the allowed bases maps
+    to a flattened position with one searchsorted, so placements for every interval and permutation are one matrix.
+    '''
+    def __init__(self, chrom_lengths, exclude=None):
+        self.chroms = list(chrom_lengths.keys())
+        self.lengths = np.array([chrom_lengths[chrom] for chrom in self.chroms], dtype=np.int64)
+        self.offsets = np.cumsum(self.lengths) - self.lengths  # flattened position of each chromosome's first base
+        exclude = to_interval_set(exclude if exclude is not None else [])
+        segment_starts, segment_ends = [], []
+        for code, chrom in enumerate(self.chroms):
+            gap_starts, gap_ends = merge_intervals(*exclude.chromosome(chrom))
+            gap_starts = np.clip(gap_starts, 0, self.lengths[code])
+            gap_ends = np.clip(gap_ends, 0, self.lengths[code])
+            starts = np.r_[0, gap_ends]  # allowed segments are the complement of the gaps
+            ends = np.r_[gap_starts, self.lengths[code]]
+            keep = ends > starts
+            segment_starts.append(starts[keep] + self.offsets[code])
+            segment_ends.append(ends[keep] + self.offsets[code])
+        self.segment_starts = np.concatenate(segment_starts).astype(np.int64)
+        self.segment_ends = np.concatenate(segment_ends).astype(np.int64)
+        segment_lengths = self.segment_ends - self.segment_starts
+        self.cumulative = np.cumsum(segment_lengths)  # allowed bases up to and including each segment
+        # allowed bases before and through each chromosome, and its longest segment, for draws that keep a chromosome
+        first = np.searchsorted(self.segment_starts, self.offsets, side='left')
+        last = np.searchsorted(self.segment_starts, self.offsets + self.lengths, side='left')
+        cumulative_before = np.r_[0, self.cumulative]
+        self.chrom_allowed_start = cumulative_before[first]
+        self.chrom_allowed_end = cumulative_before[last]
+        self.chrom_first_segment = first
+        self.chrom_last_segment = last
+        self.chrom_longest_segment = np.array([segment_lengths[i:j].max(initial=0) for i, j in zip(first, last)], dtype=np.int64)
+
+    def sample(self, lengths, codes, num_permutations, rng):
+        '''
+        Draw random start positions, in flattened coordinates, for intervals of the given lengths so that every interval
+        lies inside one allowed segment: on chromosome self.chroms[codes[i]], or anywhere if codes is None. Draws that
+        would run past the end of their segment are redrawn, which keeps placements uniform over all valid starts; once
+        a round of redraws fails for more than half of them, as when intervals barely fit their segments, the rest are
+        drawn from the valid starts directly by draw_valid, so the redraws stay bounded. Called by permutation_test.
+        Returns an integer matrix of shape (num_permutations, len(lengths)).
+        '''
+        if codes is None:
+            low = np.zeros(len(lengths), dtype=np.int64)
+            high = np.full(len(lengths), self.cumulative[-1] if len(self.cumulative) else 0, dtype=np.int64)
+            longest = np.full(len(lengths), (self.segment_ends - self.segment_starts).max(initial=0), dtype=np.int64)
+        else:
+            low = self.chrom_allowed_start[codes]
+            high = self.chrom_allowed_end[codes]
+            longest = self.chrom_longest_segment[codes]
+        if np.any(lengths > longest):
+            raise ValueError("an interval is longer than every allowed region it can be placed in")
+        draws = rng.integers(low, high, size=(num_permutations, len(lengths)), dtype=np.int64)
+        segments = np.searchsorted(self.cumulative, draws, side='right')
+        rows, columns = np.nonzero(self.cumulative[segments] - draws < lengths)  # too close to the end of the segment
+        while len(rows):
+            draws[rows, columns] = rng.integers(low[columns], high[columns], dtype=np.int64)
+            segments[rows, columns] = np.searchsorted(self.cumulative, draws[rows, columns], side='right')
+            redraw = self.cumulative[segments[rows, columns]] - draws[rows, columns] < lengths[columns]
+            slow = 2 * np.count_nonzero(redraw) > len(rows)
+            rows, columns = rows[redraw], columns[redraw]
+            if slow and len(rows):
+                draws[rows, columns], segments[rows, columns] = self.draw_valid(
+                    lengths[columns], None if codes is None else codes[columns], rng)
+                break
+        return self.segment_ends[segments] - (self.cumulative[segments] - draws)
+
+    def draw_valid(self, lengths, codes, rng):
+        '''
+        Draw one start per interval uniformly from its valid starts, without rejection. Within the interval's
+        chromosome (or the whole genome if codes is None) the segments are ordered from longest to shortest, so the
+        ones that can hold a length-L interval come first and the first j of them hold prefix[j] - j * (L - 1) valid
+        starts; binary searches over j find how many segments fit and which one a uniform draw falls in. Called by
+        sample. Returns (draws, segments): positions in allowed-base coordinates and segment indices, as in sample.
+        '''
+        segment_lengths = self.segment_ends - self.segment_starts
+        if codes is None:
+            order = np.argsort(-segment_lengths, kind='stable')
+            first = np.zeros(len(lengths), dtype=np.int64)
+            last = np.full(len(lengths), len(order), dtype=np.int64)
+        else:
+            segment_chroms = np.repeat(np.arange(len(self.chroms)), self.chrom_last_segment - self.chrom_first_segment)
+            order = np.lexsort((-segment_lengths, segment_chroms))  # still grouped by chromosome
+            first = self.chrom_first_segment[codes]
+            last = self.chrom_last_segment[codes]
+        sorted_lengths = segment_lengths[order]
+        prefix = np.r_[0, np.cumsum(sorted_lengths)]
+
+        def valid_starts(count):  # valid starts in the first count segments of each interval's range
+            return prefix[first + count] - prefix[first] - count * (lengths - 1)
+
+        fitting = bisect_last(np.zeros_like(first), last - first, lambda count: sorted_lengths[first + count - 1] >= lengths)
+        draws = rng.integers(0, valid_starts(fitting), dtype=np.int64)
+        before = bisect_last(np.zeros_like(first), fitting, lambda count: valid_starts(count) <= draws)
+        segments = order[first + before]
+        return self.cumulative[segments] - segment_lengths[segments] + draws - valid_starts(before), segments
+
+    def flatten(self, interval_tree):
+        '''
+        Map a merged index into flattened coordinates as one chromosome named GENOME_CHROM, clipping intervals to their
+        chromosome and dropping chromosomes outside the space. Called by permutation_test. Returns an IntervalTree.
+        '''
+        starts, ends = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        for code, chrom in enumerate(self.chroms):
+            if chrom in interval_tree.starts:
+                starts.append(np.minimum(interval_tree.starts[chrom], self.lengths[code]) + self.offsets[code])
+                ends.append(np.minimum(interval_tree.ends[chrom], self.lengths[code]) + self.offsets[code])
+        starts = np.concatenate(starts)
+        flat_tree = IntervalTree()
+        flat_tree.insert_intervals(IntervalSet([GENOME_CHROM], np.zeros(len(starts), dtype=np.int64), starts, np.concatenate(ends)))
+        return flat_tree
 
 # Helper functions
 def calculate_overlap_with_tree(set_a, interval_tree):
     '''
-    Calculate the overlap between set_a and the intervals in interval tree. Called by permutation_test. Returns total overlap.
+    Calculate the overlap between set_a and the intervals in the interval tree. Returns the total overlap.
     '''
     overlap = 0
-    merged_intervals = merge_intervals(set_a)
-    
-    for query_interval in merged_intervals:
-        overlapping_intervals = interval_tree.find_overlaps(query_interval)
-        
-        for _, overlap_start, overlap_end in overlapping_intervals:
-            overlap_start_pos = max(query_interval[1], overlap_start) # find the start position of the overlap
-            overlap_end_pos = min(query_interval[2], overlap_end) # find the end position of the overlap
-            overlap += overlap_end_pos - overlap_start_pos
-
+    for chrom, starts, ends in to_interval_set(set_a).chromosomes():
+        overlap += int(sweep_overlap(chrom, *merge_intervals(starts, ends), interval_tree))
     return overlap
 
-def randomize_ranges(set_a, chrom_lengths):
-    '''
-    Randomize the start positions of the intervals in set_a. Called by permutation_test. Returns a list of randomized intervals.'''
-    randomized_set_a = []
-    for chrom, start, end in set_a:
-        interval_length = end - start
-        chrom_length = chrom_lengths[chrom]
-        new_start = random.randint(0, chrom_length - interval_length)
-        randomized_set_a.append((chrom, new_start, new_start + interval_length))
-    return randomized_set_a
-
-def merge_intervals(intervals):
-    '''
-    Merge overlapping intervals. Called by permutation_test and insert_intervals. Returns a list of merged intervals.'''
-    if not intervals:
-        return []
-    intervals.sort(key=lambda x: (x[0], x[1]))
-    merged = []  
-    current = intervals[0]
-    for next_interval in intervals[1:]:
-        if current[0] == next_interval[0] and current[2] >= next_interval[1]: # check same chromosome and overlap
-            current = (current[0], current[1], max(current[2], next_interval[2]))
-        else:
-            merged.append(current) # append current interval if no overlap
-            current = next_interval
-    merged.append(current)
-    return merged  
+def build_interval_set(chroms, starts, ends):
+    '''
+    Build a sorted IntervalSet from parallel sequences of chromosome names, starts and ends. Chromosome codes follow
+    the order in which chromosomes first appear, so an input that is already sorted (as most BED files are) is
+    used as is, without a sort or any copy. Called by load_ranges and to_interval_set. Returns an IntervalSet.
+    '''
+    codes = {}  # chromosome name -> code, in order of first appearance
+    chrom_codes = np.fromiter((codes.setdefault(chrom, len(codes)) for chrom in chroms), dtype=np.int64, count=len(chroms))
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    same_chrom = chrom_codes[1:] == chrom_codes[:-1]
+    if np.all((chrom_codes[1:] > chrom_codes[:-1]) | (same_chrom & (starts[1:] >= starts[:-1]))):
+        return IntervalSet(codes.keys(), chrom_codes, starts, ends)
+    order = np.lexsort((starts, chrom_codes))  # sort by chromosome, then start
+    return IntervalSet(codes.keys(), chrom_codes[order], starts[order], ends[order])
 
-def permutation_test(set_a, set_b, chrom_lengths, num_permutations=10000):
+def to_interval_set(intervals):
     '''
-    Perform permutation test for overall observed overlap. Returns total observed overlap and p-value.
+    Accept either an IntervalSet or a list of (chromosome, start, end) tuples. Returns an IntervalSet.
     '''
-    total_observed_overlap = 0
-    total_permuted_overlaps = [0] * num_permutations
-    for chrom in chrom_lengths.keys():
-        # filter intervals by the current chromosome
-        set_a_chrom = [interval for interval in set_a if interval[0] == chrom]
-        set_b_chrom = [interval for interval in set_b if interval[0] == chrom]
-        
-        if not set_a_chrom or not set_b_chrom:
-            continue 
-        
+    if isinstance(intervals, IntervalSet):
+        return intervals
+    return build_interval_set([interval[0] for interval in intervals], [interval[1] for interval in intervals],
+                              [interval[2] for interval in intervals])
+
+def bisect_last(low, high, fits):
+    '''
+    Vectorized binary search: for every element, the largest k in [low, high] for which fits(k) holds, where fits
+    holds up to some k and fails after it and fits(low) is assumed. fits is called with an array of candidates and
+    returns a boolean array. Called by GenomeSpace.draw_valid. Returns an integer array.
+    '''
+    low, high = low.copy(), high.copy()
+    while (low < high).any():
+        middle = (low + high + 1) // 2
+        active = low < high
+        fit = fits(middle)
+        low = np.where(active & fit, middle, low)
+        high = np.where(active & ~fit, middle - 1, high)
+    return low
+
+def merge_intervals(starts, ends):
+    '''
+    Merge overlapping intervals of one chromosome, given start-sorted arrays. Called by insert_intervals and
+    calculate_overlap_with_tree. Returns merged start and end arrays (the input arrays themselves if nothing overlaps).
+    '''
+    if len(starts) == 0:
+        return np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+    reach = np.maximum.accumulate(ends)  # furthest end seen so far
+    # an interval opens a new merged interval if it starts after everything before it has ended
+    opens = starts[1:] > reach[:-1]
+    if opens.all():  # already merged, e.g. a pre-merged reference: keep the input views instead of copying
+        return starts, ends
+    first = np.flatnonzero(np.r_[True, opens])
+    last = np.r_[first[1:] - 1, len(starts) - 1]
+    return np.asarray(starts[first], dtype=np.int64), np.asarray(reach[last], dtype=np.int64)
+
+def sweep_overlap(chrom, starts, ends, interval_tree):
+    '''
+    Count the bases shared by sorted, disjoint query intervals and the merged intervals of the tree on chrom.
+    Both sides are sorted, so this is one sweep: each query boundary is located among the tree intervals by a
+    searchsorted over sorted needles, and the bases between two boundaries are read off the tree's running coverage.
+    Works along the last axis, so a matrix of shuffled sets is scored in the same call. Called by
+    calculate_overlap_with_tree and calculate_batch_overlaps. Returns the total overlap (one per row for a matrix).
+    '''
+    if chrom not in interval_tree.starts:
+        return np.zeros(np.shape(starts)[:-1], dtype=np.int64)
+    tree_starts = interval_tree.starts[chrom]
+    tree_ends = interval_tree.ends[chrom]
+    boundaries = np.stack((starts, ends), axis=-1)  # start, end, start, end, ... stays sorted for disjoint intervals
+    index = np.searchsorted(tree_starts, boundaries, side='right') - 1  # last tree interval starting at or before each boundary
+    # bases of that tree interval that extend past the boundary are not covered yet
+    covered = interval_tree.cumulative[chrom][index] - np.maximum(tree_ends[index] - boundaries, 0)
+    covered = np.where(index >= 0, covered, 0)
+    return (covered[..., 1] - covered[..., 0]).sum(axis=-1)
+
+def merge_shuffled_rows(shuffled_starts, lengths):
+    '''
+    Sort each row of shuffled intervals and clip every interval to begin where the ones before it in the row stopped;
+    the clipped intervals are disjoint and cover exactly the merged set, so overlaps are not double counted.
+    Called by calculate_batch_overlaps. Returns the clipped starts and ends.
+    '''
+    order = np.argsort(shuffled_starts, axis=1)
+    starts = np.take_along_axis(shuffled_starts, order, axis=1)
+    ends = starts + lengths[order]
+    reach = np.maximum.accumulate(ends, axis=1)
+    reach = np.concatenate((starts[:, :1], reach[:, :-1]), axis=1)
+    return np.maximum(starts, reach), np.maximum(ends, reach)
+
+def calculate_batch_overlaps(chrom, shuffled_starts, lengths, interval_tree):
+    '''
+    Calculate the overlap between each row of shuffled intervals and the intervals in the interval tree.
+    Called by permutation_test. Returns an array with the total overlap of each row.
+    '''
+    starts, ends = merge_shuffled_rows(shuffled_starts, lengths)
+    return sweep_overlap(chrom, starts, ends, interval_tree)
+
+def p_value_settled(num_extreme, num_done, alpha=None, precision=None):
+    '''
+    Check whether a running permutation p-value is settled, using a Wilson score interval around num_extreme / num_done.
+    Called by permutation_test. Returns True once the interval lies entirely below or above alpha, or once its
+    half-width is at most precision.
+    '''
+    if alpha is None and precision is None:
+        return False
+    z_squared = EARLY_STOP_Z ** 2
+    center = (num_extreme + z_squared / 2) / (num_done + z_squared)
+    half_width = EARLY_STOP_Z * np.sqrt(num_extreme * (num_done - num_extreme) / num_done + z_squared / 4) / (num_done + z_squared)
+    if alpha is not None and (center + half_width < alpha or center - half_width > alpha):
+        return True
+    return precision is not None and half_width <= precision
+
+def build_permutation_state(set_a, set_b, chrom_lengths, exclude=None):
+    '''
+    Index set_b (unless it is an IntervalTree already), lay the genome out as a GenomeSpace and collect the set_a
+    intervals of every chromosome in chrom_lengths that both sets use. Called by permutation_test. Returns a dictionary with the interval tree, the flattened tree, the genome space and
+    the set_a starts, ends and chromosome codes.
+    '''
+    set_a = to_interval_set(set_a)
+    if isinstance(set_b, IntervalTree):
+        interval_tree = set_b  # already indexed, e.g. by load_index
+    else:
         interval_tree = IntervalTree()
-        interval_tree.insert_intervals(set_b_chrom)
-        
-        observed_overlap = calculate_overlap_with_tree(set_a_chrom, interval_tree) # calculate observed overlap for this chromosome
-        total_observed_overlap += observed_overlap 
-        
-        for i in range(num_permutations): # calculate permuted overlaps for this chromosome
-            shuffled_a = randomize_ranges(set_a_chrom, chrom_lengths)
-            permuted_overlap = calculate_overlap_with_tree(shuffled_a, interval_tree)
-            total_permuted_overlaps[i] += permuted_overlap  
+        interval_tree.insert_intervals(set_b)
+    genome_space = GenomeSpace(chrom_lengths, exclude)
+    starts, ends, codes = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    for code, chrom in enumerate(genome_space.chroms):
+        chrom_starts, chrom_ends = set_a.chromosome(chrom)
+        if not len(chrom_starts) or chrom not in interval_tree.starts:
+            continue 
+        starts.append(chrom_starts)
+        ends.append(chrom_ends)
+        codes.append(np.full(len(chrom_starts), code, dtype=np.int64))
+    return {'interval_tree': interval_tree, 'genome_tree': genome_space.flatten(interval_tree), 'genome_space': genome_space,
+            'starts': np.concatenate(starts), 'ends': np.concatenate(ends), 'codes': np.concatenate(codes)}
+
+_worker_state = {}  # permutation state of the current process, filled once by init_permutation_worker
+
+def init_permutation_worker(state):
+    '''
+    Store the permutation state once per worker process so tasks only carry a seed and a block size. No return value.
+    '''
+    _worker_state.clear()
+    _worker_state.update(state)
+
+def share_permutation_state(state, directory):
+    '''
+    Select the parts of a build_permutation_state dictionary that run_permutation_block reads, with the flattened tree
+    saved in directory and memory-mapped, so worker processes map its pages instead of rebuilding or copying it.
+    Called by permutation_test. Returns the state to pass to init_permutation_worker.
+    '''
+    return {'genome_tree': state['genome_tree'].share(os.path.join(directory, 'genome_tree.npy')),
+            'genome_space': state['genome_space'], 'starts': state['starts'], 'ends': state['ends'], 'codes': state['codes']}
+
+def run_permutation_block(task):
+    '''
+    Score one block of permutations over all chromosomes; every shuffled interval stays on its own chromosome.
+    Called by permutation_test, possibly in a worker process. Returns an array with the overlap of each permutation.
+    '''
+    seed_sequence, block_size = task
+    lengths = _worker_state['ends'] - _worker_state['starts']
+    rng = np.random.default_rng(seed_sequence)
+    shuffled_starts = _worker_state['genome_space'].sample(lengths, _worker_state['codes'], block_size, rng)
+    return calculate_batch_overlaps(GENOME_CHROM, shuffled_starts, lengths, _worker_state['genome_tree'])
+
+def permutation_test(set_a, set_b, chrom_lengths, num_permutations=10000, seed=None, batch_size=None, workers=1,
+                     alpha=None, precision=None, exclude=None):
+    '''
+    Perform permutation test for overall observed overlap. Shuffled intervals stay on their chromosome and avoid the
+    exclude intervals; all chromosomes share one flattened coordinate space (GenomeSpace), so a block of permutations
+    is one matrix of shuffled starts, batch_size rows at a time (by default about BATCH_ELEMENTS placements), scored
+    with array operations. Each block gets its own seed spawned from seed, so the p-value does not depend on how many
+    workers run the blocks. If alpha or precision is given, num_permutations is only an upper bound: the test stops
+    after the first block at which p_value_settled holds.
+    Returns total observed overlap, p-value and the number of permutations used.
+    '''
+    state = build_permutation_state(set_a, set_b, chrom_lengths, exclude)
+    total_observed_overlap = 0
+    for code in np.unique(state['codes']): # observed overlap for each chromosome
+        chrom = state['genome_space'].chroms[code]
+        chrom_intervals = state['codes'] == code
+        starts, ends = merge_intervals(state['starts'][chrom_intervals], state['ends'][chrom_intervals])
+        total_observed_overlap += int(sweep_overlap(chrom, starts, ends, state['interval_tree']))
+
+    if batch_size is None:
+        batch_size = max(1, BATCH_ELEMENTS // max(len(state['starts']), 1))
+    block_sizes = [min(batch_size, num_permutations - block_start) for block_start in range(0, num_permutations, batch_size)]
+    tasks = list(zip(np.random.SeedSequence(seed).spawn(len(block_sizes)), block_sizes))
+
+    def count_extreme(results):
+        '''
+        Count permutations with overlap >= observed, block by block. Returns the count and the permutations used.
+        '''
+        num_extreme = 0
+        permutations_used = 0
+        for block_size, permuted_overlaps in zip(block_sizes, results):
+            num_extreme += np.count_nonzero(permuted_overlaps >= total_observed_overlap)
+            permutations_used += block_size
+            if p_value_settled(num_extreme, permutations_used, alpha, precision):
+                break
+        return num_extreme, permutations_used
+
+    if workers > 1:
+        with tempfile.TemporaryDirectory() as directory:
+            worker_state = share_permutation_state(state, directory)
+            with multiprocessing.Pool(workers, initializer=init_permutation_worker, initargs=(worker_state,)) as pool:
+                num_extreme, permutations_used = count_extreme(pool.imap(run_permutation_block, tasks))
+    else:
+        _worker_state.clear()
+        _worker_state.update(state)
+        num_extreme, permutations_used = count_extreme(map(run_permutation_block, tasks))
             
-    p_value = (sum(x >= total_observed_overlap for x in total_permuted_overlaps)) / num_permutations
-    return total_observed_overlap, p_value
+    p_value = num_extreme / permutations_used
+    return total_observed_overlap, p_value, permutations_used
+
+def run_matrix_block(task):
+    '''
+    Draw and merge one block of shuffled placements of a query set and score it against every reference. Called by
+    permutation_matrix, possibly in a worker process. Returns an array of overlaps with one row per reference (in the
+    order of the references) and one column per permutation.
+    '''
+    query, seed_sequence, block_size = task
+    lengths, codes = _worker_state['queries'][query]
+    rng = np.random.default_rng(seed_sequence)
+    shuffled_starts, shuffled_ends = merge_shuffled_rows(_worker_state['genome_space'].sample(lengths, codes, block_size, rng), lengths)
+    return np.array([sweep_overlap(GENOME_CHROM, shuffled_starts, shuffled_ends, genome_tree)
+                     for genome_tree in _worker_state['genome_trees']]).reshape(-1, block_size)
+
+def permutation_matrix(query_sets, reference_sets, chrom_lengths, num_permutations=10000, seed=None, batch_size=None,
+                       alpha=None, precision=None, exclude=None, workers=1):
+    '''
+    Perform the permutation test for every pair of query set and reference track (all-vs-all enrichment). Each
+    reference is indexed and flattened into the GenomeSpace once, and each block of shuffled placements of a query set
+    is drawn and merged once and then scored against every reference, so the cost grows with the number of files
+    rather than the number of pairs. Every query set gets its own seed spawned from seed, and each of its blocks a
+    seed spawned from that, so the result does not depend on how many workers run the blocks; with workers > 1 the
+    flattened references are shared with the worker processes as memory-mapped files, as in permutation_test.
+    Shuffled intervals stay on their chromosome, as in permutation_test. If alpha or precision is given, a query set
+    stops after the first block at which p_value_settled holds against every reference.
+    Returns dictionaries of observed overlap and p-value keyed by (query, reference), and a dictionary of the
+    permutations used per query.
+    '''
+    genome_space = GenomeSpace(chrom_lengths, exclude)
+    interval_trees, genome_trees = {}, []
+    for reference, set_b in reference_sets.items():
+        if isinstance(set_b, IntervalTree):
+            interval_trees[reference] = set_b
+        else:
+            interval_trees[reference] = IntervalTree()
+            interval_trees[reference].insert_intervals(set_b)
+        genome_trees.append(genome_space.flatten(interval_trees[reference]))
+
+    observed, queries = {}, {}  # queries: query -> (lengths, chromosome codes) of its intervals
+    for query, set_a in query_sets.items():
+        set_a = to_interval_set(set_a)
+        starts, ends, codes = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        for reference in reference_sets:
+            observed[(query, reference)] = 0
+        for code, chrom in enumerate(genome_space.chroms):
+            chrom_starts, chrom_ends = set_a.chromosome(chrom)
+            if not len(chrom_starts):
+                continue
+            starts.append(chrom_starts)
+            ends.append(chrom_ends)
+            codes.append(np.full(len(chrom_starts), code, dtype=np.int64))
+            merged_starts, merged_ends = merge_intervals(chrom_starts, chrom_ends)
+            for reference, interval_tree in interval_trees.items():
+                observed[(query, reference)] += int(sweep_overlap(chrom, merged_starts, merged_ends, interval_tree))
+        queries[query] = (np.concatenate(ends) - np.concatenate(starts), np.concatenate(codes))
+    state = {'genome_space': genome_space, 'genome_trees': genome_trees, 'queries': queries}
+
+    p_values, permutations_used = {}, {}
+
+    def count_extreme(run_blocks):
+        '''
+        Count, query by query and block by block, the permutations with overlap >= observed against every reference,
+        scoring the blocks with run_blocks (map or a pool's imap). Fills p_values and permutations_used. No return value.
+        '''
+        for (query, (lengths, _)), query_seed in zip(queries.items(), np.random.SeedSequence(seed).spawn(len(queries))):
+            query_batch_size = batch_size or max(1, BATCH_ELEMENTS // max(len(lengths), 1))
+            block_sizes = [min(query_batch_size, num_permutations - block_start)
+                           for block_start in range(0, num_permutations, query_batch_size)]
+            tasks = [(query, block_seed, block_size) for block_size, block_seed in zip(block_sizes, query_seed.spawn(len(block_sizes)))]
+            thresholds = np.array([observed[(query, reference)] for reference in reference_sets]).reshape(-1, 1)
+            num_extreme = np.zeros(len(reference_sets), dtype=np.int64)
+            permutations_used[query] = 0
+            for block_size, permuted_overlaps in zip(block_sizes, run_blocks(run_matrix_block, tasks)):
+                num_extreme += np.count_nonzero(permuted_overlaps >= thresholds, axis=1)
+                permutations_used[query] += block_size
+                if all(p_value_settled(count, permutations_used[query], alpha, precision) for count in num_extreme.tolist()):
+                    break
+            for reference, count in zip(reference_sets, num_extreme.tolist()):
+                p_values[(query, reference)] = count / permutations_used[query]
+
+    if workers > 1:
+        with tempfile.TemporaryDirectory() as directory:
+            worker_state = dict(state, genome_trees=[genome_tree.share(os.path.join(directory, f'genome_tree.{index}.npy'))
+                                                     for index, genome_tree in enumerate(genome_trees)])
+            with multiprocessing.Pool(workers, initializer=init_permutation_worker, initargs=(worker_state,)) as pool:
+                count_extreme(pool.imap)
+    else:
+        init_permutation_worker(state)
+        count_extreme(map)
+    return observed, p_values, permutations_used
+
+def write_matrix(filename, queries, references, observed, p_values, permutations_used):
+    '''
+    Write the result of permutation_matrix as a tab-separated N x M table: one row per query set, and for each
+    reference an observed overlap column and a p-value column. No return value.
+    '''
+    with open(filename, 'w') as file:
+        header = ['query', 'permutations_used']
+        for reference in references:
+            header += [f'{reference}:observed', f'{reference}:p_value']
+        file.write('\t'.join(header) + '\n')
+        for query in queries:
+            row = [query, str(permutations_used[query])]
+            for reference in references:
+                row += [str(observed[(query, reference)]), f'{p_values[(query, reference)]:.4g}']
+            file.write('\t'.join(row) + '\n')
+
+def cache_paths(filename, suffix=CACHE_SUFFIX):
+    '''
+    Get the sidecar cache paths of an input file. Returns the column array path and the metadata path.
+    '''
+    return filename + suffix + '.npy', filename + suffix + '.json'
 
-def load_ranges(filename):
+def read_cache(filename, suffix=CACHE_SUFFIX):
+    '''
+    Open the sidecar cache of a parsed input file if it still matches the file's mtime and size. Called by load_ranges,
+    load_index and parse_fai_file. Returns (memory-mapped column array, chromosome names), or None if there is no valid cache.
     '''
-    Load intervals from a file. Returns a list of intervals.'''
-    ranges = []  
+    columns_path, metadata_path = cache_paths(filename, suffix)
+    try:
+        with open(metadata_path, 'r') as file:
+            metadata = json.load(file)
+        stat = os.stat(filename)
+        if metadata['mtime_ns'] != stat.st_mtime_ns or metadata['size'] != stat.st_size:
+            return None
+        return np.load(columns_path, mmap_mode='r'), metadata['chroms']
+    except (OSError, ValueError, KeyError):
+        return None
+
+def replace_file(path, mode, write):
+    '''
+    Write a file by calling write(file) on a new temporary file in the same directory, then rename it over path. The
+    temporary name is unique, so concurrent writers of the same path never write into one file. No return value.
+    '''
+    descriptor, temporary_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                                  dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(descriptor, mode) as file:
+            write(file)
+        os.chmod(temporary_path, 0o644)  # mkstemp creates the file readable by its owner only
+        os.replace(temporary_path, path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+def write_cache(filename, stat, columns, chrom_names, suffix=CACHE_SUFFIX):
+    '''
+    Write the sidecar cache of a parsed input file, tagged with the mtime and size the file had before parsing.
+    Files are written under unique temporary names and renamed (replace_file), metadata last, so readers never see a
+    partial cache, even while other processes write the same cache.
+    A cache that cannot be written (e.g. read-only directory) is skipped. No return value.
+    '''
+    columns_path, metadata_path = cache_paths(filename, suffix)
+    metadata = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'chroms': list(chrom_names)}
+    try:
+        replace_file(columns_path, 'wb', lambda file: np.save(file, columns))
+        replace_file(metadata_path, 'w', lambda file: json.dump(metadata, file))
+    except OSError:
+        pass
+
+def load_ranges(filename, use_cache=True):
+    '''
+    Load intervals from a file. With use_cache, a valid sidecar cache is memory-mapped instead of parsing the file,
+    and a fresh parse writes one. Returns an IntervalSet.
+    '''
+    if use_cache:
+        cached = read_cache(filename)
+        if cached is not None:
+            columns, chrom_names = cached
+            return IntervalSet(chrom_names, columns[0], columns[1], columns[2])
+    stat = os.stat(filename)
+    chroms, starts, ends = [], [], []
     with open(filename, 'r') as file:
         for line in file:
             if line.strip():
                 parts = line.strip().split('\t')
-                chrom = parts[0]
-                start = int(parts[1])
-                end = int(parts[2])
-                ranges.append((chrom, start, end))  
-    return ranges
+                chroms.append(parts[0])
+                starts.append(int(parts[1]))
+                ends.append(int(parts[2]))
+    interval_set = build_interval_set(chroms, starts, ends)
+    if use_cache:
+        columns = np.stack((interval_set.chrom_codes, interval_set.starts, interval_set.ends))  # one row per column
+        write_cache(filename, stat, columns, interval_set.chrom_names)
+    return interval_set
 
-def parse_fai_file(fai_file):
+def load_index(filename, use_cache=True):
     '''
-    Parse the fai file to get chromosome lengths. Returns a dictionary of chromosome lengths.
+    Load a reference interval file as a merged IntervalTree. With use_cache the index is saved once as a sidecar
+    (<file>.index.npy and <file>.index.json) that later runs and concurrent worker processes memory-map read-only,
+    so they skip parsing, merging and building and share the index pages. Returns an IntervalTree.
     '''
+    if use_cache:
+        cached = read_cache(filename, INDEX_SUFFIX)
+        if cached is not None:
+            columns, chrom_names = cached
+            return IntervalTree.from_columns(chrom_names, columns, path=os.path.abspath(filename))
+    stat = os.stat(filename)
+    interval_tree = IntervalTree()
+    interval_tree.insert_intervals(load_ranges(filename, use_cache))
+    if use_cache:
+        write_cache(filename, stat, interval_tree.to_columns(), interval_tree.starts.keys(), INDEX_SUFFIX)
+    return interval_tree
+
+def load_columns(columns_path, chrom_names):
+    '''
+    Memory-map an index saved by IntervalTree.share read-only. Called when a worker process unpickles a shared index.
+    Returns an IntervalTree.
+    '''
+    interval_tree = IntervalTree.from_columns(chrom_names, np.load(columns_path, mmap_mode='r'))
+    interval_tree.columns_path = columns_path
+    return interval_tree
+
+def parse_fai_file(fai_file, use_cache=True):
+    '''
+    Parse the .fai file to get the chromosome lengths. With use_cache, a valid sidecar cache is read instead of parsing.
+    Returns a dictionary of chromosome lengths.
+    '''
+    if use_cache:
+        cached = read_cache(fai_file)
+        if cached is not None:
+            lengths, chroms = cached
+            return dict(zip(chroms, lengths[0].tolist()))
+    stat = os.stat(fai_file)
     chrom_lengths = {}
     with open(fai_file, 'r') as file:
         for line in file:
             chrom, length, *_ = line.strip().split()
             chrom_lengths[chrom] = int(length)
+    if use_cache:
+        write_cache(fai_file, stat, np.array([list(chrom_lengths.values())], dtype=np.int64), chrom_lengths.keys())
     return chrom_lengths
 
 def main():    
     # start time
     import time
     start_time = time.time()
+    parser = argparse.ArgumentParser(description="Permutation test for the overlap of two BED interval sets, per chromosome.")
+    parser.add_argument("set_a", help="Path to SetA.bed (with --matrix: comma-separated query BED files).")
+    parser.add_argument("set_b", help="Path to SetB.bed (with --matrix: comma-separated reference BED files).")
+    parser.add_argument("fai", help="Path to genome.fa.fai.")
+    parser.add_argument("num_permutations", type=int, nargs="?", default=10000, help="Number of permutations (default 10000).")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes (default 1).")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed; results are identical for any --workers.")
+    parser.add_argument("--alpha", type=float, default=None, help="Stop early once the p-value is clearly below or above this significance level.")
+    parser.add_argument("--precision", type=float, default=None, help="Stop early once the p-value confidence interval half-width is at most this.")
+    parser.add_argument("--exclude", default=None, help="BED file of regions (e.g. assembly gaps) shuffled intervals must avoid.")
+    parser.add_argument("--no-cache", action="store_true", help="Always parse the input files; do not read or write sidecar caches.")
+    parser.add_argument("--matrix", default=None, help="Test every query set against every reference and write the N x M table of observed overlaps and p-values to this TSV file.")
+    args = parser.parse_args()
     print("Running...")
-    if len(sys.argv) != 4 and len(sys.argv) != 5:
-        print("Usage: python submission.py path/to/SetA.bed path/to/SetB.bed path/to/genome.fa.fai [num_permutations]")  
-        sys.exit(1) 
-    set_a_path = sys.argv[1] 
-    set_b_path = sys.argv[2]
-    fai_path = sys.argv[3]
-    num_permutations = int(sys.argv[4]) if len(sys.argv) == 5 else 10000  # set default for num_permutations if not provided
-    
-    chrom_lengths = parse_fai_file(fai_path)
-    set_a = load_ranges(set_a_path)
-    set_b = load_ranges(set_b_path)
     
-    total_observed_overlap, p_value = permutation_test(set_a, set_b, chrom_lengths, num_permutations)
-    print(f'Number of overlapping bases observed: {total_observed_overlap}, p value: {p_value:.4f}')
+    chrom_lengths = parse_fai_file(args.fai, use_cache=not args.no_cache)
+    exclude = load_ranges(args.exclude, use_cache=not args.no_cache) if args.exclude else None
+    if args.matrix:
+        queries, references = args.set_a.split(','), args.set_b.split(',')
+        query_sets = {query: load_ranges(query, use_cache=not args.no_cache) for query in queries}
+        reference_sets = {reference: load_index(reference, use_cache=not args.no_cache) for reference in references}
+        observed, p_values, permutations_used = permutation_matrix(query_sets, reference_sets, chrom_lengths,
+                                                                   args.num_permutations, seed=args.seed,
+                                                                   alpha=args.alpha, precision=args.precision,
+                                                                   exclude=exclude, workers=args.workers)
+        write_matrix(args.matrix, queries, references, observed, p_values, permutations_used)
+        print(f'Wrote {len(queries)} x {len(references)} overlap matrix to {args.matrix}')
+    else:
+        set_a = load_ranges(args.set_a, use_cache=not args.no_cache)
+        set_b = load_index(args.set_b, use_cache=not args.no_cache)
+        total_observed_overlap, p_value, permutations_used = permutation_test(set_a, set_b, chrom_lengths, args.num_permutations,
+                                                                              seed=args.seed, workers=args.workers,
+                                                                              alpha=args.alpha, precision=args.precision,
+                                                                              exclude=exclude)
+        print(f'Number of overlapping bases observed: {total_observed_overlap}, p value: {p_value:.4f}, permutations used: {permutations_used}')
     # end time
     end_time = time.time()
     print(f"Time taken: {end_time - start_time:.2f} seconds")
 if __name__ == "__main__":  
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,78 @@
+import os
+import numpy as np
+
+def read_expression_file(filepath):
+    """
+    reads one experiment csv file (a header line, then gene,expression lines) in bulk and returns the list of genes and a float64 array of expressions.
+    a file with only a header gives no genes; a line that does not have exactly two fields raises a ValueError.
+    """
+
+    with open(filepath, 'r') as file:
+        next(file, None)  # skip header
+        lines = file.read().split('\n')
+    lines = [line for line in lines if line.strip()]
+    if not lines:
+        return [], np.empty(0, dtype=np.float64)
+
+    fields = ','.join(lines).split(',')
+    if len(fields) != 2 * len(lines):  # some line has a missing or an extra field, which would shift every pair after it
+        bad = next(line for line in lines if line.count(',') != 1)
+        raise ValueError(f"{filepath}: expected gene,expression lines, got {bad.strip()!r}")
+    genes = [gene.strip() for gene in fields[0::2]]
+    expressions = np.array(fields[1::2], dtype=np.float64)
+    return genes, expressions
+
+def read_expression_matrices(*directories):
+    """
+    reads all csv files of each directory into a dense gene x sample matrix of library-size normalized expressions.
+    all matrices share one gene index (genes in order of first appearance); a gene missing from a file is NaN.
+    returns the list of genes and one matrix per directory.
+    """
+
+    gene_index = {}  # key = gene, value = row of the gene in every matrix
+    columns_per_directory = []  # for each directory, a list of (rows, expressions) tuples, one per file
+
+    for directory in directories:
+        columns = []
+        for filename in sorted(os.listdir(directory)):
+            if filename.endswith('.csv'):
+                genes, expressions = read_expression_file(os.path.join(directory, filename))
+                rows = np.array([gene_index.setdefault(gene, len(gene_index)) for gene in genes], dtype=np.intp)
+                columns.append((rows, expressions))
+        columns_per_directory.append(columns)
+
+    matrices = []
+    for columns in columns_per_directory:
+        matrix = np.full((len(gene_index), len(columns)), np.nan)
+        for sample, (rows, expressions) in enumerate(columns):
+            matrix[rows, sample] = expressions
+        matrix /= np.nansum(matrix, axis=0)  # normalize every sample by its total expression
+        matrices.append(matrix)
+
+    return list(gene_index), matrices  # return (genes, [gene x sample matrix for each directory])
+
+def get_means_medians(matrix):
+    """
+    computes the mean and median normalized expression of each gene (row), skipping missing values, and returns them as a tuple of arrays.
+    genes without any value get NaN.
+    """
+
+    if not np.isnan(matrix).any():
+        return matrix.mean(axis=1), np.median(matrix, axis=1)
+    means = np.full(len(matrix), np.nan)
+    medians = np.full(len(matrix), np.nan)
+    present = ~np.isnan(matrix).all(axis=1)  # genes seen in at least one sample
+    means[present] = np.nanmean(matrix[present], axis=1)
+    medians[present] = np.nanmedian(matrix[present], axis=1)
+    return means, medians
+
+def compute_log2_fold_changes(control_means, treatment_means):
+    """
+    computes the log2 fold change between control and treatment means for each gene (inf where the control mean is not positive).
+    genes missing from either group get NaN.
+    """
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log2_fold_changes = np.where(control_means > 0, np.log2(treatment_means / control_means), np.inf)
+    log2_fold_changes[np.isnan(control_means) | np.isnan(treatment_means)] = np.nan
+    return log2_fold_changes
@@ -1,67 +1,8 @@
-import os
 import sys
 import statistics
 import math
-
-def read_and_normalize_files(directory):
-    """
-    reads and normalizes gene expression data from all csv files in a given directory and returns as a dictionary.
-    """
-    
-    gene_data_dict = {}  # dict of lists: key = each gene, value = list of all that gene's normalized expression values from all files
-    
-    for filename in os.listdir(directory):
-        if filename.endswith('.csv'):
-            filepath = os.path.join(directory, filename)  # get full path of file
-            total_expression = 0  # for expression sum
-            expressions_list = []  # for (gene, expression) tuples
-
-            with open(filepath, 'r') as file:
-                next(file)  # skip header
-                for line in file:
-                    gene, expression = line.strip().split(',')
-                    expression = float(expression)
-                    expressions_list.append((gene, expression))  # store gene & expression as tuple
-                    total_expression += expression  # add to total expression
-            
-            for gene, expression in expressions_list:  # iterate over each tuple in expressions list for the given file
-                normalized_expression = expression / total_expression  # formula for normalization
-                if gene not in gene_data_dict:
-                    gene_data_dict[gene] = []  # initialize empty list to populate with normalized expression values for that gene
-                gene_data_dict[gene].append(normalized_expression)  # add normalized expression value from current file to end of list
-
-    return gene_data_dict  # dict of lists ({gene: [normalized_expressions]})
-
-def get_mean_median_tuple(gene_data):
-    """
-    computes the mean and median normalized expressions for each gene and returns as a tuple of means and medians dictionaries.
-    """
-    
-    means_dict = {}  # key = gene, value = mean of normalized expression values
-    medians_dict = {}  # key = gene, value = median of normalized expression values
-
-    for gene, expressions in gene_data.items():
-        means_dict[gene] = statistics.mean(expressions)  # calculate mean of expressions for each gene and store in means dict
-        medians_dict[gene] = statistics.median(expressions)  # calculate median of expressions for each gene and store in medians dict
-
-    return means_dict, medians_dict  # return tuple of 2 dicts: ({gene: mean}, {gene: median})
-
-def compute_log2_fold_change(control_means, treatment_means):
-    """
-    computes the log2 fold change between control and treatment means for each gene.
-    """
-    
-    log2_fold_changes_dict = {}  # empty dict to store log2 fold changes
-
-    for gene in control_means:
-        if gene in treatment_means:
-            control_mean = control_means[gene]  # get means for each group
-            treatment_mean = treatment_means[gene]  
-            
-            log2_fold_change = math.log2(treatment_mean / control_mean) if control_mean > 0 else float('inf')
-            log2_fold_changes_dict[gene] = log2_fold_change  # store in dict for each gene
-
-    return log2_fold_changes_dict  # dict of log2 fold changes ({gene: log2_fold_change}).
+import numpy as np
+from expression_matrix import read_expression_matrices, get_means_medians, compute_log2_fold_changes
 
 def mann_whitney_u_test(control_expr_list, treatment_expr_list):
     """
@@ -92,27 +33,23 @@ def main(control_dir, treatment_dir):
     main function to read gene expression data, compute statistics, and write results to a file.
     """
     
-    control_data_dict = read_and_normalize_files(control_dir)
-    treatment_data_dict = read_and_normalize_files(treatment_dir)
+    genes, (control_matrix, treatment_matrix) = read_expression_matrices(control_dir, treatment_dir)
     
-    control_means_dict, control_medians_dict = get_mean_median_tuple(control_data_dict)
-    treatment_means_dict, treatment_medians_dict = get_mean_median_tuple(treatment_data_dict)
-    log2_fold_changes_dict = compute_log2_fold_change(control_means_dict, treatment_means_dict)
+    control_means, control_medians = get_means_medians(control_matrix)
+    treatment_means, treatment_medians = get_means_medians(treatment_matrix)
+    log2_fold_changes = compute_log2_fold_changes(control_means, treatment_means)
 
     results = []
 
-    for gene in log2_fold_changes_dict:
-        mean_control = control_means_dict[gene]
-        median_control = control_medians_dict[gene]
-        mean_treatment = treatment_means_dict[gene]
-        median_treatment = treatment_medians_dict[gene]
-        log2_fold_change = log2_fold_changes_dict[gene]
-        
-        control_expressions_list = control_data_dict[gene] if gene in control_data_dict else []
-        treatment_expressions_list = treatment_data_dict[gene] if gene in treatment_data_dict else []
+    for row in np.flatnonzero(~np.isnan(log2_fold_changes)).tolist():  # genes present in both groups
+        control_expressions = control_matrix[row]
+        treatment_expressions = treatment_matrix[row]
+        control_expressions_list = control_expressions[~np.isnan(control_expressions)].tolist()
+        treatment_expressions_list = treatment_expressions[~np.isnan(treatment_expressions)].tolist()
         p_value = mann_whitney_u_test(control_expressions_list, treatment_expressions_list)
 
-        results.append((gene, mean_control, median_control, mean_treatment, median_treatment, log2_fold_change, p_value))
+        results.append((genes[row], control_means[row].item(), control_medians[row].item(), treatment_means[row].item(),
+                        treatment_medians[row].item(), log2_fold_changes[row].item(), p_value))
     
     results.sort(key=lambda x: x[-1])  # sort results by p-value
 
@@ -0,0 +1,208 @@
+import argparse
+import importlib.util
+import inspect
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+# interval modules benchmarked, as (name, path relative to the repository root)
+MODULES = [('interval_overlap_analysis', 'interval_overlap_analysis/interval_overlap_analysis.py'),
+           ('chromosome_specific_interval_tree', 'chromosome_specific_interval_tree/chromosome_specific_interval_tree.py')]
+# number of hotspot windows per chromosome that clustered intervals are drawn into
+HOTSPOTS_PER_CHROM = 20
+
+def load_module(name, path):
+    '''
+    Import one of the interval modules from its script file (the project folders are not packages). The module is
+    registered in sys.modules so its functions can be pickled for worker processes. Returns the module.
+    '''
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    spec = importlib.util.spec_from_file_location(name, os.path.join(root, path))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def generate_genome(num_chroms, chrom_length):
+    '''
+    Generate chromosome lengths for a synthetic genome of num_chroms chromosomes named chr1, chr2, ...
+    Returns a dictionary of chromosome lengths.
+    '''
+    return {f'chr{index + 1}': int(chrom_length) for index in range(num_chroms)}
+
+def generate_intervals(chrom_lengths, num_intervals, mean_length, length_distribution, hotspot_fraction, hotspots, rng):
+    '''
+    Generate num_intervals random intervals spread over the chromosomes in proportion to their length. Lengths are
+    'fixed', 'exponential' or 'lognormal' with the given mean. A hotspot_fraction of the intervals is placed inside the
+    shared hotspot windows instead of uniformly, which controls how densely the intervals (and two sets generated with
+    the same hotspots) overlap. Returns arrays of chromosome names, starts and ends, sorted by chromosome and start.
+    '''
+    chroms = np.array(list(chrom_lengths))
+    sizes = np.array(list(chrom_lengths.values()), dtype=np.int64)
+    if length_distribution == 'fixed':
+        lengths = np.full(num_intervals, mean_length, dtype=np.int64)
+    elif length_distribution == 'exponential':
+        lengths = rng.exponential(mean_length, num_intervals).astype(np.int64)
+    elif length_distribution == 'lognormal':
+        sigma = 1.0
+        lengths = rng.lognormal(np.log(mean_length) - sigma ** 2 / 2, sigma, num_intervals).astype(np.int64)
+    else:
+        raise ValueError(f'Unknown length distribution: {length_distribution}')
+    codes = rng.choice(len(chroms), size=num_intervals, p=sizes / sizes.sum())
+    lengths = np.clip(lengths, 1, sizes[codes])
+    starts = (rng.random(num_intervals) * (sizes[codes] - lengths + 1)).astype(np.int64)
+    in_hotspot = rng.random(num_intervals) < hotspot_fraction
+    if in_hotspot.any():
+        window_starts, window_ends = hotspots
+        window = rng.integers(0, window_starts.shape[1], size=num_intervals)[in_hotspot]
+        low = window_starts[codes[in_hotspot], window]
+        high = np.maximum(window_ends[codes[in_hotspot], window] - lengths[in_hotspot], low)
+        starts[in_hotspot] = low + (rng.random(len(low)) * (high - low + 1)).astype(np.int64)
+    order = np.lexsort((starts, codes))
+    return chroms[codes[order]], starts[order], starts[order] + lengths[order]
+
+def generate_hotspots(chrom_lengths, window_length, rng):
+    '''
+    Draw HOTSPOTS_PER_CHROM windows of window_length bases on every chromosome. Returns arrays of window starts and
+    ends with one row per chromosome.
+    '''
+    sizes = np.array(list(chrom_lengths.values()), dtype=np.int64)
+    window_length = np.minimum(window_length, sizes)[:, None]
+    window_starts = (rng.random((len(sizes), HOTSPOTS_PER_CHROM)) * (sizes[:, None] - window_length + 1)).astype(np.int64)
+    return window_starts, window_starts + window_length
+
+def write_bed(filename, chroms, starts, ends):
+    '''
+    Write intervals to a BED file. No return value.
+    '''
+    with open(filename, 'w') as file:
+        for chrom, start, end in zip(chroms.tolist(), starts.tolist(), ends.tolist()):
+            file.write(f'{chrom}\t{start}\t{end}\n')
+
+def write_fai(filename, chrom_lengths):
+    '''
+    Write chromosome lengths as a FASTA index (.fai) file. No return value.
+    '''
+    with open(filename, 'w') as file:
+        for chrom, length in chrom_lengths.items():
+            file.write(f'{chrom}\t{length}\t0\t60\t61\n')
+
+def count_intervals(filename):
+    '''
+    Count the non-empty lines of a BED file. Returns the number of intervals.
+    '''
+    with open(filename, 'r') as file:
+        return sum(1 for line in file if line.strip())
+
+def measure(stage, repeat):
+    '''
+    Run stage() repeat times and keep the fastest wall-clock time, then run it once more under tracemalloc to record
+    the peak of memory allocated during the stage (NumPy arrays included). tracemalloc only sees this process, so the
+    peak resident set size of the worker processes that have exited so far is read from getrusage as well; it is a
+    high-water mark over the whole run, not just this stage. Returns the last result, the time in seconds, the peak
+    in bytes and the largest worker peak in KiB (0 if no worker has run).
+    '''
+    seconds = float('inf')
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = stage()
+        seconds = min(seconds, time.perf_counter() - start_time)
+    tracemalloc.start()
+    result = stage()
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, seconds, peak_bytes, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+def benchmark_module(module, set_a_path, set_b_path, fai_path, num_permutations, seed, repeat, workers=1):
+    '''
+    Time each stage of one interval module on the given input files: parse, merge, index build, observed overlap and
+    permutations. Parsing bypasses the sidecar caches so it measures the parser itself. Returns a dictionary with,
+    per stage, the seconds taken, the number of items processed, the throughput, the peak memory allocated by this
+    process and the peak resident set size of the worker processes.
+    '''
+    chrom_lengths = module.parse_fai_file(fai_path, use_cache=False)
+    stages = {}
+
+    def record(name, stage, items):
+        '''
+        Measure one stage and store its row. Returns the stage result.
+        '''
+        result, seconds, peak_bytes, workers_max_rss_kib = measure(stage, repeat)
+        stages[name] = {'seconds': seconds, 'items': items, 'items_per_second': items / seconds if seconds else None,
+                        'peak_bytes': peak_bytes, 'workers_max_rss_kib': workers_max_rss_kib}
+        return result
+
+    num_a, num_b = count_intervals(set_a_path), count_intervals(set_b_path)
+    set_a, set_b = record('parse', lambda: (module.load_ranges(set_a_path, use_cache=False),
+                                            module.load_ranges(set_b_path, use_cache=False)), num_a + num_b)
+    record('merge', lambda: [module.merge_intervals(starts, ends) for _, starts, ends in set_b.chromosomes()], num_b)
+
+    def build_index():
+        '''
+        Index set_b from scratch. Returns the IntervalTree.
+        '''
+        interval_tree = module.IntervalTree()
+        interval_tree.insert_intervals(set_b)
+        return interval_tree
+
+    interval_tree = record('index_build', build_index, num_b)
+    observed = record('observed_overlap', lambda: module.calculate_overlap_with_tree(set_a, interval_tree), num_a)
+    options = {'workers': workers} if 'workers' in inspect.signature(module.permutation_test).parameters else {}
+    _, p_value, permutations_used = record('permutations', lambda: module.permutation_test(
+        set_a, interval_tree, chrom_lengths, num_permutations, seed=seed, **options), num_a * num_permutations)
+    return {'stages': stages, 'observed_overlap': observed, 'p_value': p_value, 'permutations_used': permutations_used}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the interval modules on synthetic BED/FAI inputs.")
+    parser.add_argument("--intervals", type=int, default=100000, help="Intervals per set (default 100000).")
+    parser.add_argument("--chroms", type=int, default=10, help="Number of chromosomes (default 10).")
+    parser.add_argument("--chrom-length", type=int, default=10000000, help="Length of every chromosome (default 10000000).")
+    parser.add_argument("--mean-length", type=int, default=1000, help="Mean interval length (default 1000).")
+    parser.add_argument("--length-distribution", choices=['fixed', 'exponential', 'lognormal'], default='lognormal',
+                        help="Interval length distribution (default lognormal).")
+    parser.add_argument("--hotspot-fraction", type=float, default=0.2,
+                        help="Fraction of intervals placed in shared hotspot windows, i.e. the overlap density (default 0.2).")
+    parser.add_argument("--hotspot-length", type=int, default=100000, help="Length of each hotspot window (default 100000).")
+    parser.add_argument("--permutations", type=int, default=100, help="Permutations per test (default 100).")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per stage; the fastest is kept (default 3).")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes for chromosome_specific_interval_tree (default 1).")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the inputs and the permutations (default 0).")
+    parser.add_argument("--output", default="interval_benchmark_results.jsonl",
+                        help="Results file; one JSON record is appended per run (default interval_benchmark_results.jsonl).")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    chrom_lengths = generate_genome(args.chroms, args.chrom_length)
+    hotspots = generate_hotspots(chrom_lengths, args.hotspot_length, rng)
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        set_a_path, set_b_path = os.path.join(directory, 'SetA.bed'), os.path.join(directory, 'SetB.bed')
+        fai_path = os.path.join(directory, 'genome.fa.fai')
+        for path in (set_a_path, set_b_path):
+            write_bed(path, *generate_intervals(chrom_lengths, args.intervals, args.mean_length, args.length_distribution,
+                                                args.hotspot_fraction, hotspots, rng))
+        write_fai(fai_path, chrom_lengths)
+        for name, path in MODULES:
+            module = load_module(name, path)
+            results[name] = benchmark_module(module, set_a_path, set_b_path, fai_path, args.permutations, args.seed,
+                                             args.repeat, args.workers)
+            for stage, row in results[name]['stages'].items():
+                print(f"{name:34} {stage:18} {row['seconds']:9.4f} s {row['items_per_second']:14.0f} items/s "
+                      f"{row['peak_bytes'] / 2 ** 20:9.1f} MiB {row['workers_max_rss_kib'] / 2 ** 10:9.1f} MiB workers")
+
+    record = {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'), 'config': vars(args),
+              'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+              'max_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              'workers_max_rss_kib': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss, 'modules': results}
+    with open(args.output, 'a') as file:
+        file.write(json.dumps(record) + '\n')
+    print(f"Results appended to {args.output}")
+
+if __name__ == "__main__":
+    main()
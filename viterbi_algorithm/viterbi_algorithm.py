@@ -1,6 +1,14 @@
-import sys
+import argparse
+import collections
+import gzip
+import io
+import multiprocessing
+import os
+import re
+import tempfile
 import numpy as np
-import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+from matplotlib.figure import Figure
 
 # transition probabilities
 P_INBRED_TO_OUTBRED = 1 / (1.5 * 10**6)
@@ -10,6 +18,25 @@ P_OUTBRED_TO_INBRED = 1 / (4 * 10**6)
 e = 1 / 1000
 EPSILON = 1e-10  
 
+# hidden states, indexed by state code
+STATES = ['inbred', 'outbred']
+# log transition probabilities, LOG_TRANSITIONS[previous state, state]
+LOG_TRANSITIONS = np.log(np.array([[1 - P_INBRED_TO_OUTBRED, P_INBRED_TO_OUTBRED],
+                                   [P_OUTBRED_TO_INBRED, 1 - P_OUTBRED_TO_INBRED]]))
+# transition probabilities, TRANSITIONS[previous state, state]
+TRANSITIONS = np.exp(LOG_TRANSITIONS)
+# genotype codes; any genotype not in GENOTYPE_CODES (e.g. missing './.') is coded as MISSING
+HOMOZYGOUS, HETEROZYGOUS, MISSING = 0, 1, 2
+GENOTYPE_CODES = {'0/0': HOMOZYGOUS, '1/1': HOMOZYGOUS, '0/1': HETEROZYGOUS, '1/0': HETEROZYGOUS}
+# plot colors of the states, indexed by state code
+STATE_COLORS = ['blue', 'red']
+# sites whose emission table is computed at a time by viterbi_advance
+EMISSION_BLOCK = 65536
+# read buffer of vcf files; compressed files are decompressed this many bytes at a time
+READ_BUFFER_BYTES = 1 << 24
+# sample genotype fields converted to arrays at a time when reading a vcf file
+CHUNK_FIELDS = 500000
+
 def emission_prob(genotype, p, q, inbred_state):
     """calculate emission probability based on genotype and state."""
     if genotype == '0/0' or genotype == '1/1':  # homozygous
@@ -24,141 +51,448 @@ def emission_prob(genotype, p, q, inbred_state):
             return max(2 * p * q, EPSILON)  # outbred state probability
     return EPSILON  # return a small value for undefined genotypes
 
+def encode_genotypes(genotypes):
+    """convert genotype strings to int8 genotype codes."""
+    return np.fromiter((GENOTYPE_CODES.get(genotype, MISSING) for genotype in genotypes), dtype=np.int8, count=len(genotypes))
+
+def emission_table(allele_freqs):
+    """calculate log emission probabilities for every site and genotype code, as an (n, 3, 2) array indexed by
+    [site, genotype code, state]."""
+    p = np.asarray(allele_freqs, dtype=np.float64)
+    het_outbred = 2 * p * (1 - p)  # outbred heterozygote probability 2pq
+    table = np.empty((len(p), 3, 2))
+    table[:, HOMOZYGOUS, 0] = np.log(max(1 - e, EPSILON))
+    table[:, HETEROZYGOUS, 0] = np.log(max(e, EPSILON))
+    table[:, HOMOZYGOUS, 1] = np.log(np.maximum(1 - het_outbred, EPSILON))
+    table[:, HETEROZYGOUS, 1] = np.log(np.maximum(het_outbred, EPSILON))
+    table[:, MISSING, :] = np.log(EPSILON)
+    return table
+
+def log_emissions(codes, allele_freqs):
+    """calculate log emission probabilities of all sites at once, as an (n, 2) array of inbred and outbred columns."""
+    codes = np.asarray(codes)
+    return emission_table(allele_freqs)[np.arange(len(codes)), codes]
+
 def viterbi(genotypes, allele_freqs):
-    """perform viterbi algorithm to determine the most probable states."""
-    n = len(genotypes)  # number of genotypes
-    states = ['inbred', 'outbred']  # possible states
-    
-    # initialize dynamic programming table and backpointer table
-    v = np.full((2, n), -np.inf) 
-    backpointer = np.zeros((2, n), dtype=int) 
-
-    p, q = allele_freqs[0], 1 - allele_freqs[0]  # allele frequencies
-    # initialize the first column of the viterbi table
-    v[0, 0] = np.log(emission_prob(genotypes[0], p, q, 'inbred')) + np.log(0.5)
-    v[1, 0] = np.log(emission_prob(genotypes[0], p, q, 'outbred')) + np.log(0.5)
-
-    # fill the viterbi table for each genotype
+    """perform viterbi algorithm to determine the most probable states.
+
+    genotypes are genotype strings or codes from encode_genotypes. the log emissions are computed for the whole
+    chromosome up front, so the recursion over sites only adds and compares floats and records each backpointer as a
+    single byte.
+    """
+    codes = genotypes if isinstance(genotypes, np.ndarray) else encode_genotypes(genotypes)
+    n = len(codes)  # number of genotypes
+    inbred_emissions, outbred_emissions = log_emissions(codes, allele_freqs).T.tolist()
+    (inbred_to_inbred, inbred_to_outbred), (outbred_to_inbred, outbred_to_outbred) = LOG_TRANSITIONS.tolist()
+
+    # backpointers: 1 where the best predecessor of the state at site t is outbred
+    inbred_backpointer = bytearray(n)
+    outbred_backpointer = bytearray(n)
+
+    # initialize with the first site
+    inbred = inbred_emissions[0] + np.log(0.5)
+    outbred = outbred_emissions[0] + np.log(0.5)
+
+    # advance the two scores site by site
     for t in range(1, n):
-        p, q = allele_freqs[t], 1 - allele_freqs[t]  # allele frequencies for the current position
-        for s in range(2):
-            if s == 0:  # inbred state
-                trans_probs = [v[0, t-1] + np.log(1 - P_INBRED_TO_OUTBRED), v[1, t-1] + np.log(P_OUTBRED_TO_INBRED)]
-                v[0, t] = np.log(emission_prob(genotypes[t], p, q, 'inbred')) + max(trans_probs)
-                backpointer[0, t] = np.argmax(trans_probs)
-            else:  # outbred state
-                trans_probs = [v[0, t-1] + np.log(P_INBRED_TO_OUTBRED), v[1, t-1] + np.log(1 - P_OUTBRED_TO_INBRED)]
-                v[1, t] = np.log(emission_prob(genotypes[t], p, q, 'outbred')) + max(trans_probs)
-                backpointer[1, t] = np.argmax(trans_probs)
+        stay, switch = inbred + inbred_to_inbred, outbred + outbred_to_inbred
+        if switch > stay:
+            inbred_backpointer[t] = 1
+            stay = switch
+        leave, remain = inbred + inbred_to_outbred, outbred + outbred_to_outbred
+        if remain > leave:
+            outbred_backpointer[t] = 1
+            leave = remain
+        inbred, outbred = inbred_emissions[t] + stay, outbred_emissions[t] + leave
 
     # traceback to find the best path
-    best_path = []
-    last_state = np.argmax(v[:, -1])
-    best_path.append(states[last_state])
-
+    last_state = 1 if outbred > inbred else 0
+    best_path = [STATES[last_state]]
     for t in range(n - 1, 0, -1):
-        last_state = backpointer[last_state, t]
-        best_path.append(states[last_state])
+        last_state = outbred_backpointer[t] if last_state else inbred_backpointer[t]
+        best_path.append(STATES[last_state])
 
     best_path.reverse()  # reverse the path since we traced it backwards
     return best_path
 
-def parse_vcf(file_path):
-    """parse vcf file and extract genotypes for each individual by chromosome."""
-    genotypes_by_individual = {}
-    
-    with open(file_path, "r") as file:
+def viterbi_advance(scores, codes, allele_freqs, first, last, packed=None):
+    """advance the (samples, 2) viterbi scores in place over sites first to last - 1.
+
+    emissions are computed EMISSION_BLOCK sites at a time. if packed is given, the backpointers of these sites are
+    stored in it bit-packed along the sites: bit 7 - (t - first) % 8 of packed[(t - first) // 8, sample, state] is
+    set where the best predecessor is outbred.
+    """
+    from_inbred = np.empty_like(scores)
+    from_outbred = np.empty_like(scores)
+    backpointers = np.zeros((8,) + scores.shape, dtype=bool)  # backpointers of the current byte of sites
+    for block in range(first, last, EMISSION_BLOCK):
+        table = emission_table(allele_freqs[block:min(block + EMISSION_BLOCK, last)])
+        for t in range(block, min(block + EMISSION_BLOCK, last)):
+            np.add(scores[:, :1], LOG_TRANSITIONS[0], out=from_inbred)
+            np.add(scores[:, 1:], LOG_TRANSITIONS[1], out=from_outbred)
+            if packed is not None:
+                bit = (t - first) % 8
+                np.greater(from_outbred, from_inbred, out=backpointers[bit])
+                if bit == 7 or t == last - 1:
+                    packed[(t - first) // 8] = np.packbits(backpointers, axis=0)[0]
+            np.maximum(from_inbred, from_outbred, out=scores)
+            scores += table[t - block, codes[t]]
+
+def viterbi_traceback(current, packed, first, last, changes):
+    """trace the best paths back from current, the (samples,) state codes at site last - 1, through the backpointers
+    of sites first to last - 1, packed by viterbi_advance; current is left holding the states at site first - 1.
+    every site t where a sample's state differs from its state at t - 1 is appended to changes as (t, samples, their
+    states at t), so only the state changes are stored."""
+    samples = np.arange(len(current))
+    for t in range(last - 1, first - 1, -1):
+        offset = t - first
+        previous = (packed[offset // 8, samples, current] >> (7 - offset % 8)) & 1
+        changed = np.flatnonzero(previous != current)
+        if len(changed):
+            changes.append((t, changed, current[changed]))
+        current[:] = previous
+
+def runs_from_changes(changes, first_states, n):
+    """assemble the run-length encoded path of every sample from the state changes recorded by viterbi_traceback and
+    the states at site 0. returns a list with one (run starts, run ends (exclusive), run states) tuple per sample, as
+    run_length_segments gives."""
+    num_samples = len(first_states)
+    sites = np.concatenate([np.zeros(num_samples, dtype=np.int64)] + [np.full(len(changed), t) for t, changed, _ in changes])
+    samples = np.concatenate([np.arange(num_samples)] + [changed for _, changed, _ in changes])
+    states = np.concatenate([first_states] + [states for _, _, states in changes]).astype(np.int8)
+    order = np.lexsort((sites, samples))
+    sites, samples, states = sites[order], samples[order], states[order]
+    last_run = np.append(samples[1:] != samples[:-1], True)  # the last run of a sample ends at the last site
+    ends = np.where(last_run, n, np.append(sites[1:], n))
+    bounds = np.flatnonzero(last_run)[:-1] + 1
+    return list(zip(np.split(sites, bounds), np.split(ends, bounds), np.split(states, bounds)))
+
+def viterbi_batch_runs(codes, allele_freqs, checkpoint=None):
+    """perform viterbi algorithm for many individuals that share the same sites and allele frequencies, returning
+    run-length encoded paths.
+
+    codes is an (n, samples) matrix of genotype codes. the dynamic programming state is a (samples, 2) array advanced
+    site by site, so the per-site work is shared by the whole cohort, and backpointers are stored as bits (a quarter
+    byte per site and sample). the traceback keeps only the current state of every sample and records where it
+    changes, so no (n, samples) matrix is ever built. with checkpoint=k, only the float64 scores at every k-th site
+    are kept in a first pass, and the backpointers are recomputed one segment of k sites at a time during the
+    traceback: this costs a second forward pass but bounds the working memory to about (16 n / k + k / 4) bytes per
+    sample (k near 8 sqrt(n) is smallest) plus the runs themselves. returns one (run starts, run ends (exclusive), run
+    states) tuple per sample, as run_length_segments gives for the path viterbi finds for that individual.
+    """
+    codes = np.asarray(codes)
+    allele_freqs = np.asarray(allele_freqs)
+    n, num_samples = codes.shape
+    if n == 0:
+        return [(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int8))] * num_samples
+    segment = n if checkpoint is None else min(max(int(checkpoint), 1), n)
+    segments = [(max(start, 1), min(start + segment, n)) for start in range(0, n, segment)]
+    packed = np.empty(((segment + 7) // 8, num_samples, 2), dtype=np.uint8)
+
+    # first pass: keep the scores where every segment starts (nothing to do without checkpoints)
+    scores = emission_table(allele_freqs[:1])[0, codes[0]] + np.log(0.5)
+    checkpoints = np.empty((len(segments),) + scores.shape)
+    checkpoints[0] = scores
+    for index in range(1, len(segments)):
+        viterbi_advance(scores, codes, allele_freqs, *segments[index - 1])
+        checkpoints[index] = scores
+
+    # second pass: recompute the backpointers of one segment at a time, last segment first, and trace back through it
+    changes, current = [], None
+    for index in reversed(range(len(segments))):
+        scores[:] = checkpoints[index]
+        viterbi_advance(scores, codes, allele_freqs, *segments[index], packed)
+        if current is None:
+            current = np.argmax(scores, axis=1).astype(np.int8)
+        viterbi_traceback(current, packed, *segments[index], changes)
+    return runs_from_changes(changes, current, n)
+
+def viterbi_batch(codes, allele_freqs, checkpoint=None, out=None):
+    """perform viterbi algorithm for many individuals that share the same sites and allele frequencies (see
+    viterbi_batch_runs). returns an (n, samples) int8 matrix of state codes (indices into STATES), written to out if
+    given; each column equals the path viterbi finds for that individual."""
+    codes = np.asarray(codes)
+    states = np.empty(codes.shape, dtype=np.int8) if out is None else out
+    for sample, (starts, ends, run_states) in enumerate(viterbi_batch_runs(codes, allele_freqs, checkpoint)):
+        states[:, sample] = np.repeat(run_states, ends - starts)
+    return states
+
+def forward_backward_batch(codes, allele_freqs):
+    """compute the posterior probability of the inbred state at every site for many individuals that share the same
+    sites and allele frequencies.
+
+    uses the same emission table and transitions as viterbi_batch. the forward and backward variables are (samples, 2)
+    arrays rescaled to sum to one at every site, so they cannot underflow, and only the forward inbred share is kept
+    between the two passes. returns an (n, samples) float32 matrix of posterior inbred probabilities.
+    """
+    codes = np.asarray(codes)
+    allele_freqs = np.asarray(allele_freqs)
+    n, num_samples = codes.shape
+    posterior = np.empty((n, num_samples), dtype=np.float32)
+    forward = np.empty((n, num_samples))  # scaled forward probability of the inbred state
+
+    # forward pass
+    alpha = np.full((num_samples, 2), 0.5)  # initial state probabilities
+    for block in range(0, n, EMISSION_BLOCK):
+        table = np.exp(emission_table(allele_freqs[block:min(block + EMISSION_BLOCK, n)]))
+        for t in range(block, min(block + EMISSION_BLOCK, n)):
+            if t > 0:
+                alpha = np.dot(alpha, TRANSITIONS)
+            alpha *= table[t - block, codes[t]]
+            alpha /= alpha.sum(axis=1, keepdims=True)
+            forward[t] = alpha[:, 0]
+
+    # backward pass, combined with the forward shares into the posterior
+    beta = np.ones((num_samples, 2))
+    for block in reversed(range(0, n, EMISSION_BLOCK)):
+        table = np.exp(emission_table(allele_freqs[block:min(block + EMISSION_BLOCK, n)]))
+        for t in range(min(block + EMISSION_BLOCK, n) - 1, block - 1, -1):
+            inbred = forward[t] * beta[:, 0]
+            posterior[t] = inbred / (inbred + (1 - forward[t]) * beta[:, 1])
+            beta = np.dot(beta * table[t - block, codes[t]], TRANSITIONS.T)
+            beta /= beta.sum(axis=1, keepdims=True)
+    return posterior
+
+def decode_block(task):
+    """decode one block of samples of one chromosome, possibly in a worker process. genotype codes and allele
+    frequencies are memory-mapped from .npy files, so only file names and sample indices are pickled. returns the
+    run-length encoded paths of the block's samples, as viterbi_batch_runs gives."""
+    codes_path, freqs_path, first, last, checkpoint = task
+    codes = np.load(codes_path, mmap_mode='r')
+    return viterbi_batch_runs(codes[:, first:last], np.load(freqs_path, mmap_mode='r'), checkpoint)
+
+def decode_chromosomes(chromosomes, workers=1, checkpoint=None):
+    """decode a stream of (individuals, chrom, data) chromosomes, as iter_vcf_chromosomes yields them, for all
+    individuals. yields (individuals, chrom, positions, paths) in stream order, where paths holds the run-length
+    encoded path of every sample as viterbi_batch_runs gives, the same for any number of workers.
+
+    with workers > 1, one process pool serves the whole stream: the samples of each chromosome are split into workers
+    blocks decoded in the pool, and up to workers chromosomes are in flight at once, so chromosomes are still decoded
+    concurrently when there are few samples. inputs are shared through memory-mapped files in a temporary directory,
+    removed once the chromosome is decoded.
+    """
+    if workers <= 1:
+        for individuals, chrom, data in chromosomes:
+            yield individuals, chrom, data["positions"], viterbi_batch_runs(data["codes"], data["allele_freqs"], checkpoint)
+        return
+    with tempfile.TemporaryDirectory() as directory, multiprocessing.Pool(workers) as pool:
+        pending = collections.deque()  # chromosomes in flight: (individuals, chrom, positions, input files, block results)
+
+        def finish():
+            """wait for the oldest chromosome in flight and remove its files. returns its decoded tuple."""
+            individuals, chrom, positions, files, results = pending.popleft()
+            paths = [run for result in results for run in result.get()]
+            for file in files:
+                os.remove(file)
+            return individuals, chrom, positions, paths
+
+        for index, (individuals, chrom, data) in enumerate(chromosomes):
+            codes_path, freqs_path = [os.path.join(directory, f"{index}.{name}.npy") for name in ("codes", "allele_freqs")]
+            np.save(codes_path, data["codes"])
+            np.save(freqs_path, data["allele_freqs"])
+            bounds = np.linspace(0, data["codes"].shape[1], workers + 1).astype(int)
+            results = [pool.apply_async(decode_block, ((codes_path, freqs_path, first, last, checkpoint),))
+                       for first, last in zip(bounds[:-1], bounds[1:]) if last > first]
+            pending.append((individuals, chrom, data["positions"], (codes_path, freqs_path), results))
+            if len(pending) > workers:
+                yield finish()
+        while pending:
+            yield finish()
+
+FORMAT_SUBFIELDS = re.compile(':[^\t]*')  # everything after the GT subfield of a sample field
+
+class GenotypeFieldCodes(dict):
+    """genotype code of each distinct GT subfield (e.g. '0|1'), decoded the first time it is seen. keyed on the GT
+    subfield only, so the cache stays as small as the set of genotypes in the file."""
+    def __missing__(self, genotype):
+        code = self[genotype] = GENOTYPE_CODES.get(genotype.replace('|', '/'), MISSING)
+        return code
+
+def parse_allele_freq(info):
+    """extract the AF value from an INFO field, 0.5 if it is not provided."""
+    start = (';' + info).find(';AF=')
+    if start < 0:
+        return 0.5
+    return float(info[start + 3:].split(';', 1)[0])
+
+def check_sample_fields(records, num_samples):
+    """raise a ValueError for the first record (a data line split into at most 10 columns) that has fewer than the 8
+    fixed vcf columns or whose number of sample fields differs from num_samples. no return value."""
+    for record in records:
+        if len(record) < 8:
+            line = '\t'.join(record)
+            raise ValueError(f"vcf data line has {len(record)} columns, expected at least 8: {line[:80]!r}")
+        fields = record[9].count('\t') + 1 if len(record) == 10 else 0
+        if fields != num_samples:
+            raise ValueError(f"vcf data line {record[0]}:{record[1]} has {fields} sample fields, but the header lists "
+                             f"{num_samples} samples")
+
+def parse_vcf_lines(lines, num_samples, field_codes):
+    """convert a chunk of vcf data lines to arrays. returns a list of (chrom, positions, allele frequencies, genotype
+    codes) with one entry per chromosome in the chunk, in order of first appearance. raises a ValueError naming the
+    first line whose number of sample fields differs from num_samples, the number of samples in the header."""
+    records = [line.rstrip('\n').split('\t', 9) for line in lines]
+    columns = {10} if num_samples else {8, 9}  # sites-only lines have no sample columns, and maybe no FORMAT column
+    if not set(map(len, records)) <= columns:
+        check_sample_fields(records, num_samples)
+    chroms = [record[0] for record in records]
+    positions = np.array([record[1] for record in records], dtype=np.int64)
+    allele_freqs = np.array([parse_allele_freq(record[7]) for record in records], dtype=np.float32)
+    if num_samples == 0:  # sites-only vcf file
+        codes = np.zeros((len(records), 0), dtype=np.int8)
+    else:
+        # cut the sample columns of all lines down to their GT subfields and split them in one go, then look every
+        # genotype up in the code cache
+        fields = FORMAT_SUBFIELDS.sub('', '\t'.join(record[9] for record in records)).split('\t')
+        if len(fields) != len(records) * num_samples:
+            check_sample_fields(records, num_samples)
+        codes = np.array(list(map(field_codes.__getitem__, fields)), dtype=np.int8).reshape(len(records), num_samples)
+    if chroms[0] == chroms[-1] and chroms.count(chroms[0]) == len(chroms):
+        return [(chroms[0], positions, allele_freqs, codes)]
+    chroms = np.array(chroms)
+    return [(chrom, positions[chroms == chrom], allele_freqs[chroms == chrom], codes[chroms == chrom])
+            for chrom in dict.fromkeys(chroms.tolist())]
+
+def open_vcf(file_path):
+    """open a plain or gzip/bgzip compressed vcf file for reading text with a READ_BUFFER_BYTES buffer."""
+    with open(file_path, "rb") as file:
+        compressed = file.read(2) == b"\x1f\x8b"  # gzip magic number, also used by bgzip
+    raw = gzip.open(file_path, "rb") if compressed else open(file_path, "rb", buffering=0)
+    return io.TextIOWrapper(io.BufferedReader(raw, READ_BUFFER_BYTES))
+
+def iter_vcf_chunks(file_path, chunk_fields=CHUNK_FIELDS):
+    """stream the data lines of a vcf file as arrays, converting about chunk_fields sample fields at a time, so only
+    one chunk of python strings is alive at once. yields (individuals, chrom, positions, allele frequencies, genotype
+    codes) in file order; consecutive chunks may belong to the same chromosome."""
+    individuals = []
+    field_codes = GenotypeFieldCodes()
+    lines = []
+    chunk_lines = 1
+    with open_vcf(file_path) as file:
         for line in file:
             if line.startswith("#CHROM"):
-                headers = line.strip().split("\t")
-                individuals = headers[9:]  # get the list of individuals
-                for individual in individuals:
-                    genotypes_by_individual[individual] = {}
+                individuals = line.rstrip("\n").split("\t")[9:]  # get the list of individuals
+                chunk_lines = max(1, chunk_fields // max(len(individuals), 1))
                 continue
-            if line.startswith("#"):
+            if line.startswith("#") or not line.strip():
                 continue  # skip comment lines
-            
-            fields = line.strip().split("\t")
-            chrom, pos, _, ref, alt, _, _, info, _, *sample_genotypes = fields
-            pos = int(pos)
-
-            # extract allele frequency from the INFO field
-            info_dict = {item.split("=")[0]: item.split("=")[1] for item in info.split(";") if "=" in item}
-            p = float(info_dict.get("AF", 0.5))  # default allele frequency is 0.5 if not provided
-
-            for i, genotype_info in enumerate(sample_genotypes):
-                genotype = genotype_info.split(":")[0].replace("|", "/")  # extract genotype
-                individual = individuals[i]
-                
-                if chrom not in genotypes_by_individual[individual]:
-                    genotypes_by_individual[individual][chrom] = {"positions": [], "genotypes": [], "p_values": []}
-                
-                # store the genotype and associated position and allele frequency
-                genotypes_by_individual[individual][chrom]["positions"].append(pos)
-                genotypes_by_individual[individual][chrom]["genotypes"].append(genotype)
-                genotypes_by_individual[individual][chrom]["p_values"].append(p)
-
-    return genotypes_by_individual
-
-def plot_inbred_outbred(genotypes_by_individual):
-    """plot inbred and outbred regions for each individual."""
+            lines.append(line)
+            if len(lines) >= chunk_lines:
+                for chunk in parse_vcf_lines(lines, len(individuals), field_codes):
+                    yield (individuals,) + chunk
+                lines = []
+    if lines:
+        for chunk in parse_vcf_lines(lines, len(individuals), field_codes):
+            yield (individuals,) + chunk
+
+def iter_vcf_chromosomes(file_path, chunk_fields=CHUNK_FIELDS):
+    """stream a plain or gzip/bgzip compressed vcf file one chromosome at a time, so peak memory is bounded by the
+    largest chromosome rather than the whole file. the file must be grouped by chromosome, as sorted vcf files are.
+    yields (individuals, chrom, data) where data holds the chromosome's "positions" (int64), "allele_freqs" (float32)
+    and "codes" (int8 genotype codes, sites x samples)."""
+    finished = set()
+    chunks = []  # (positions, allele frequencies, codes) chunks of the current chromosome
+    current = None
+    for individuals, chrom, positions, allele_freqs, codes in iter_vcf_chunks(file_path, chunk_fields):
+        if chrom != current:
+            if chunks:
+                yield individuals, current, combine_chunks(chunks)
+                finished.add(current)
+            if chrom in finished:
+                raise ValueError(f"vcf file is not grouped by chromosome: {chrom} appears again")
+            current, chunks = chrom, []
+        chunks.append((positions, allele_freqs, codes))
+    if chunks:
+        yield individuals, current, combine_chunks(chunks)
+
+def combine_chunks(chunks):
+    """concatenate the (positions, allele frequencies, codes) chunks of one chromosome into its data dictionary."""
+    positions, allele_freqs, codes = zip(*chunks)
+    return {"positions": np.concatenate(positions), "allele_freqs": np.concatenate(allele_freqs),
+            "codes": np.concatenate(codes)}
+
+def read_vcf_columns(file_path, chunk_fields=CHUNK_FIELDS):
+    """read a whole vcf file into per-chromosome numpy arrays. returns the list of individuals and a dictionary that
+    maps each chromosome to its data, as yielded by iter_vcf_chromosomes."""
+    individuals, chromosomes = [], {}
+    for individuals, chrom, data in iter_vcf_chromosomes(file_path, chunk_fields):
+        chromosomes[chrom] = data
+    return individuals, chromosomes
+
+def run_length_segments(states):
+    """run-length encode a path of state codes. returns arrays of run starts, run ends (exclusive) and run states."""
+    change = np.flatnonzero(np.diff(states)) + 1
+    starts = np.concatenate(([0], change))
+    ends = np.concatenate((change, [len(states)]))
+    return starts, ends, states[starts]
+
+def plot_inbred_outbred(individuals, runs, output_file):
+    """plot inbred and outbred regions for each individual from the run-length encoded paths of every chromosome and
+    save the figure to output_file. the figure is rendered off-screen without pyplot, so the matplotlib backend of
+    the caller is left alone."""
     # create a figure for the plot
-    fig, ax = plt.subplots(figsize=(10, 6))
+    fig = Figure(figsize=(10, 6))
+    ax = fig.subplots()
 
-    # iterate through each individual and plot their inbred/outbred regions
+    # draw every individual as one collection of segments, one row per chromosome
     y_pos = 0  # initial y position for plotting each individual
-    for individual, chromosomes in genotypes_by_individual.items():
-        for chrom, data in chromosomes.items():
-            positions = data["positions"]
-            genotypes = data["genotypes"]
-            p_values = data["p_values"]
-
-            # run viterbi to get the best path (inbred/outbred states)
-            best_path = viterbi(genotypes, p_values)
-
-            # plot each region for the current individual
-            for i in range(1, len(best_path)):
-                if best_path[i - 1] == 'inbred':
-                    ax.plot([positions[i - 1], positions[i]], [y_pos, y_pos], color='blue', lw=6)
-                else:
-                    ax.plot([positions[i - 1], positions[i]], [y_pos, y_pos], color='red', lw=6)
-
+    for sample, individual in enumerate(individuals):
+        lines, colors = [], []
+        for chrom, (positions, paths) in runs.items():
+            starts, ends, states = paths[sample]
+            # a run covers the gap to the next site, as in one segment per adjacent site pair
+            stops = positions[np.minimum(ends, len(positions) - 1)]
+            lines += [[(start, y_pos), (stop, y_pos)] for start, stop in zip(positions[starts].tolist(), stops.tolist())]
+            colors += [STATE_COLORS[state] for state in states.tolist()]
             y_pos += 1  # move to the next individual
+        ax.add_collection(LineCollection(lines, colors=colors, linewidths=6))
 
     # add labels and title
+    ax.autoscale()
     ax.set_xlabel('Genomic Position')
     ax.set_ylabel('Individuals')
     ax.set_title('Inbred vs Outbred Regions Across Genomic Positions')
-    plt.tight_layout()
-    plt.show()
+    fig.tight_layout()
+    fig.savefig(output_file)
+
+def main(vcf_file, workers=1, checkpoint=None, plot_file="inbred_outbred_regions.png", posterior_file=None,
+         min_posterior=0.95):
+    """main function to parse vcf file and plot inbred vs outbred regions.
 
-def main(vcf_file):
-    """main function to parse vcf file and plot inbred vs outbred regions."""
-    genotypes_by_individual = parse_vcf(vcf_file)
+    with posterior_file, the regions come from forward-backward posterior decoding instead of viterbi: the posterior
+    inbred probability of every site and individual is written to posterior_file, and a site counts as inbred when
+    its posterior is at least min_posterior. posterior decoding runs in this process on whole chromosomes, so it
+    raises a ValueError if workers or checkpoint are given with it.
+    """
+    if posterior_file and (workers != 1 or checkpoint is not None):
+        raise ValueError("workers and checkpoint only apply to viterbi decoding, not to posterior decoding")
     print("individual\tstart\tstop")
 
-    for individual, chromosomes in genotypes_by_individual.items():
-        for chrom, data in chromosomes.items():
-            positions = data["positions"]
-            genotypes = data["genotypes"]
-            p_values = data["p_values"]
-            
-            # run viterbi algorithm to get the best path for this individual
-            best_path = viterbi(genotypes, p_values)
-
-            # extract inbred regions
-            inbred_regions = []
-            current_start = None
-            for i, state in enumerate(best_path):
-                if state == 'inbred':
-                    if current_start is None:
-                        current_start = positions[i]
-                else:
-                    if current_start is not None:
-                        inbred_regions.append((current_start, positions[i - 1]))
-                        current_start = None
-            if current_start is not None:
-                inbred_regions.append((current_start, positions[-1]))
+    # stream the file one chromosome at a time and decode it for all individuals at once; they share the sites and
+    # allele frequencies. only the positions and the run-length encoded paths are kept.
+    individuals, runs = [], {}
+    posterior_output = open(posterior_file, "w") if posterior_file else None
+    if posterior_output is None:
+        for individuals, chrom, positions, paths in decode_chromosomes(iter_vcf_chromosomes(vcf_file), workers, checkpoint):
+            runs[chrom] = (positions, paths)
+    else:
+        for individuals, chrom, data in iter_vcf_chromosomes(vcf_file):
+            posterior = forward_backward_batch(data["codes"], data["allele_freqs"])
+            if not runs:
+                posterior_output.write("\t".join(["chrom", "pos"] + individuals) + "\n")
+            np.savetxt(posterior_output, np.column_stack((data["positions"], posterior)), delimiter="\t",
+                       fmt=[chrom.replace("%", "%%") + "\t%d"] + ["%.4f"] * len(individuals))
+            states = np.where(posterior >= min_posterior, STATES.index('inbred'), STATES.index('outbred')).astype(np.int8)
+            runs[chrom] = (data["positions"], [run_length_segments(states[:, sample]) for sample in range(len(individuals))])
+    if posterior_output is not None:
+        posterior_output.close()
+
+    for sample, individual in enumerate(individuals):
+        for chrom, (positions, paths) in runs.items():
+            # extract inbred regions from the runs of the decoded path
+            starts, ends, states = paths[sample]
+            inbred = states == STATES.index('inbred')
+            inbred_regions = zip(positions[starts[inbred]].tolist(), positions[ends[inbred] - 1].tolist())
 
             # merge consecutive inbred regions if they are adjacent or close
             merged_regions = []
@@ -171,17 +505,26 @@ def main(vcf_file):
             for start, stop in merged_regions:
                 print(f"{individual}\t{start}\t{stop}")
 
-    # plot the inbred/outbred regions after processing
-    plot_inbred_outbred(genotypes_by_individual)
+    # plot the inbred/outbred regions after processing, reusing the decoded paths
+    plot_inbred_outbred(individuals, runs, plot_file)
 
 
 if __name__ == "__main__":
-    # check if the user provided the correct number of arguments (vcf file)
-    if len(sys.argv) != 2:
-        print("usage: python viterbi_algorithm.py input.vcf")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description="identify inbred regions of every individual in a vcf file.")
+    parser.add_argument("vcf_file", help="input vcf file, plain or gzip/bgzip compressed (.vcf.gz).")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes for viterbi decoding (default 1); not used with --posterior.")
+    parser.add_argument("--checkpoint", type=int, default=None,
+                        help="keep viterbi scores every CHECKPOINT sites and recompute backpointers per segment, to bound "
+                             "memory; not used with --posterior.")
+    parser.add_argument("--plot", default="inbred_outbred_regions.png", help="output image of the regions (default inbred_outbred_regions.png).")
+    parser.add_argument("--posterior", default=None,
+                        help="use forward-backward posterior decoding and write the posterior inbred probabilities to this tsv file.")
+    parser.add_argument("--min-posterior", type=float, default=0.95,
+                        help="posterior inbred probability a site needs to be reported as inbred with --posterior (default 0.95).")
+    args = parser.parse_args()
+    if args.posterior and (args.workers != 1 or args.checkpoint is not None):
+        parser.error("--workers and --checkpoint only apply to viterbi decoding and cannot be combined with --posterior")
 
-    # get the input vcf file from command-line arguments
-    vcf_file = sys.argv[1]
     # run the main function
-    main(vcf_file)
+    main(args.vcf_file, args.workers, args.checkpoint, args.plot, args.posterior, args.min_posterior)